@@ -1,12 +1,13 @@
 import logging
 import os
+import time
 import argparse
 
 from elasticsearch import Elasticsearch
 
 parser = argparse.ArgumentParser(description='configures elastic')
 parser.add_argument('--task', '-t', default='setup',
-                    choices=['setup', 'delete'],)
+                    choices=['setup', 'rollover', 'retention', 'delete'],)
 args = parser.parse_args()
 
 logging.basicConfig(level=logging.DEBUG)
@@ -14,6 +15,13 @@ logger = logging.getLogger(__name__)
 
 es = Elasticsearch([os.getenv('ELASTICSEARCH_URL', 'elasticsearch:9200')])
 
+# A new index is started when the current one is older or bigger than this
+ROLLOVER_MAX_AGE = os.getenv('ELASTICSEARCH_ROLLOVER_MAX_AGE', '1d')
+ROLLOVER_MAX_DOCS = int(os.getenv('ELASTICSEARCH_ROLLOVER_MAX_DOCS',
+                                  10000000))
+# Indices older than this number of days are dropped by the retention task
+RETENTION_DAYS = int(os.getenv('ELASTICSEARCH_RETENTION_DAYS', 365))
+
 settings = {
     "settings": {
         "number_of_shards": 1,
@@ -29,10 +37,13 @@ settings = {
                 "text":              {"type": "text"},
                 "tags":              {"type": "keyword"},
                 "timestamp":         {"type": "date",
-                                      "format": "yyyy/MM/dd HH:mm:ss"},
+                                      "format": "epoch_millis"},
+                "indexed_at":        {"type": "date",
+                                      "format": "epoch_millis"},
+                "ingest_lag_ms":     {"type": "long"},
                 "intent_name":       {"type": "keyword"},
                 "intent_confidence": {"type": "double"},
-                "entities":         {"type": "keyword"},
+                "entities":          {"type": "keyword"},
                 "utter_name":        {"type": "keyword"},
                 "is_fallback":       {"type": "boolean"},
             }
@@ -40,20 +51,120 @@ settings = {
     }
 }
 
+summary_settings = {
+    "settings": {
+        "number_of_shards": 1,
+        "number_of_replicas": 0
+    },
+    "mappings": {
+        "summary": {
+            "dynamic_templates": [{
+                "confidence_buckets": {
+                    "match": "confidence_bucket_*",
+                    "mapping": {"type": "long"}
+                }
+            }],
+            "properties": {
+                "minute":            {"type": "date",
+                                      "format": "epoch_millis"},
+                "environment":       {"type": "keyword"},
+                "version":           {"type": "keyword"},
+                "intent_name":       {"type": "keyword"},
+                "user_messages":     {"type": "long"},
+                "bot_messages":      {"type": "long"},
+                "fallbacks":         {"type": "long"},
+            }
+        }
+    }
+}
+
 index_name = 'messages'
+# Per minute counts written by the consumer, see metrics_aggregator.py
+summary_index_name = os.getenv('ELASTICSEARCH_SUMMARY_INDEX',
+                               'messages_summary')
+# Documents are written through this alias, it always points to the
+# newest index. Searches use the index_name alias, which holds them all.
+write_alias = index_name + '-write'
+# Matches the numbered indices only. A pattern matching the write alias
+# would apply the template to a concrete index auto-created with its name.
+index_pattern = index_name + '-0*'
+template_name = index_name + '-template'
+
+template = dict(settings,
+                index_patterns=[index_pattern],
+                aliases={index_name: {}})
+
+
+def setup():
+    logger.debug(es.indices.put_template(name=template_name, body=template))
+    logger.info('Template {} updated'.format(template_name))
+
+    if not es.indices.exists(summary_index_name):
+        logger.debug(es.indices.create(index=summary_index_name,
+                                       body=summary_settings))
+        logger.info('Created Index {}'.format(summary_index_name))
+
+    if es.indices.exists_alias(name=write_alias):
+        logger.info('Alias {} already exists'.format(write_alias))
+        return
+
+    if es.indices.exists(index_name) and \
+            not es.indices.exists_alias(name=index_name):
+        logger.error('Index {} holds the documents of the previous setup, '
+                     'reindex them into {} and delete it to use the read '
+                     'alias'.format(index_name, write_alias))
+        return
+
+    logger.debug(es.indices.create(
+        index='{}-000001'.format(index_name),
+        body={"aliases": {write_alias: {"is_write_index": True}}},
+    ))
+    logger.info('Created Index {}-000001'.format(index_name))
+
+
+def rollover():
+    response = es.indices.rollover(alias=write_alias, body={
+        "conditions": {
+            "max_age": ROLLOVER_MAX_AGE,
+            "max_docs": ROLLOVER_MAX_DOCS,
+        }
+    })
+    if response["rolled_over"]:
+        logger.info('Rolled over to {}'.format(response["new_index"]))
+    else:
+        logger.info('{} does not need to roll over yet'.format(
+            response["old_index"]))
+
+
+def retention():
+    limit = (time.time() - RETENTION_DAYS * 24 * 60 * 60) * 1000
+    indices = es.indices.get(index=index_pattern)
+
+    for name, index in indices.items():
+        alias = index.get("aliases", {}).get(write_alias, {})
+        if alias.get("is_write_index"):
+            continue
+
+        if int(index["settings"]["index"]["creation_date"]) < limit:
+            logger.debug(es.indices.delete(index=name, ignore=[400, 404]))
+            logger.info('Index {} deleted'.format(name))
+
 
 if __name__ == '__main__':
-    if args.task == 'setup':
-        try:
-            if not es.indices.exists(index_name):
-                logger.debug(es.indices.create(index=index_name, ignore=400,
-                                               body=settings))
-                logger.info('Created Index')
-            else:
-                logger.info('Index {} already exists'.format(index_name))
-        except Exception as ex:
-            logger.error(str(ex))
-
-    elif args.task == 'delete':
-        logger.debug(es.indices.delete(index=index_name, ignore=[400, 404]))
-        logger.info('Index deleted')
+    try:
+        if args.task == 'setup':
+            setup()
+        elif args.task == 'rollover':
+            rollover()
+        elif args.task == 'retention':
+            retention()
+        elif args.task == 'delete':
+            logger.debug(es.indices.delete(index=index_pattern,
+                                           ignore=[400, 404]))
+            logger.debug(es.indices.delete_template(name=template_name,
+                                                    ignore=[400, 404]))
+            logger.debug(es.indices.delete(index=summary_index_name,
+                                           ignore=[400, 404]))
+            logger.info('Indices deleted')
+    except Exception as ex:
+        logger.error(str(ex))
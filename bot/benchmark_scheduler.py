@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Compares the delayed sends of RocketChat replies with a threading.Timer
+per message, as the connector did before, and with the MessageScheduler.
+
+Each run schedules the paragraphs of a reply to every room and prints the
+peak number of threads, the peak RSS of the process and the time to send
+every message. Each run has its own process, so peaks do not add up."""
+import argparse
+import multiprocessing
+import resource
+import threading
+import time
+
+from scheduler import MessageScheduler
+
+
+class Rooms:
+    def __init__(self, rooms, paragraphs):
+        self.expected = rooms * paragraphs
+        self.sent = 0
+        self.peak_threads = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.last = {}
+        self.out_of_order = 0
+
+    def send(self, room, paragraph):
+        with self.lock:
+            self.peak_threads = max(
+                self.peak_threads, threading.active_count())
+            if self.last.get(room, -1) != paragraph - 1:
+                self.out_of_order += 1
+            self.last[room] = paragraph
+
+            self.sent += 1
+            if self.sent == self.expected:
+                self.done.set()
+
+
+def with_timers(rooms, delay, room, paragraph):
+    timer = threading.Timer(delay, rooms.send, (room, paragraph))
+    timer.start()
+
+
+def with_scheduler(scheduler):
+    def schedule(rooms, delay, room, paragraph):
+        scheduler.schedule(delay, rooms.send, room, paragraph)
+    return schedule
+
+
+def bench(name, n_rooms, paragraphs, delay, results):
+    rooms = Rooms(n_rooms, paragraphs)
+    scheduler = None
+    if name == "timers":
+        schedule = with_timers
+    else:
+        scheduler = MessageScheduler()
+        schedule = with_scheduler(scheduler)
+
+    start = time.monotonic()
+    for room in range(n_rooms):
+        for paragraph in range(paragraphs):
+            schedule(rooms, delay * (paragraph + 1), room, paragraph)
+    rooms.peak_threads = max(rooms.peak_threads, threading.active_count())
+
+    rooms.done.wait()
+    elapsed = time.monotonic() - start
+    if scheduler is not None:
+        scheduler.stop()
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((name, rooms.peak_threads, peak_rss, elapsed,
+                 rooms.out_of_order))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="benchmarks the delayed sends of RocketChat replies")
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--paragraphs", type=int, default=3)
+    parser.add_argument("--delay", type=float, default=1,
+                        help="seconds between the paragraphs of a reply")
+    args = parser.parse_args()
+
+    print("{} rooms, {} paragraphs each".format(args.rooms, args.paragraphs))
+    for name in ["timers", "scheduler"]:
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=bench,
+            args=(name, args.rooms, args.paragraphs, args.delay, results))
+        process.start()
+        name, threads, rss, elapsed, out_of_order = results.get()
+        process.join()
+
+        print("{:<10} {:>6} threads {:>8} KB peak RSS {:>7.2f}s "
+              "{} out of order".format(
+                  name, threads, rss, elapsed, out_of_order))
@@ -1,15 +1,34 @@
+import atexit
 import logging
-import threading
 import os
+import threading
 import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from typing import Text
 
 from flask import Blueprint, request, jsonify, make_response
 
 from rasa_core.channels.channel import UserMessage, OutputChannel, InputChannel
 
+from scheduler import MessageScheduler
+from typing_policy import create_typing_policy
+from webhook_queue import WebhookQueue
+
 logger = logging.getLogger(__name__)
 
+# Rooms kept in memory, the least recently active are evicted
+MAX_ROOMS = int(os.getenv("ROCKETCHAT_MAX_ROOMS", 10000))
+# Time (in seconds) after which an inactive room is forgotten
+ROOM_IDLE_TIMEOUT = float(os.getenv("ROCKETCHAT_ROOM_IDLE_TIMEOUT", 3600))
+# Rooms with the highest send latency listed by /stats
+SLOWEST_ROOMS = 10
+# Weight of the newest acknowledgement in the send latency of a room
+LATENCY_SMOOTHING = 0.2
+# "sync" answers the webhook after the bot handles the message, "async"
+# queues it to be handled by worker threads and answers right away
+WEBHOOK_MODE = os.getenv("ROCKETCHAT_WEBHOOK_MODE", "sync")
+
 
 class RocketChatBot(OutputChannel):
     @classmethod
@@ -21,12 +40,18 @@ class RocketChatBot(OutputChannel):
 
         self.username = user
         self.connector = Driver(url=server, ssl=ssl)
-        self.users = {}
+        self.rooms = RoomStore(
+            lambda rid: RocketchatHandleMessages(rid, self))
+        self.typing_policy = create_typing_policy()
         self.user = user
         self.password = password
 
         self.logged_in = False
 
+        # Delayed sends of every room, sent when the process exits
+        self.scheduler = MessageScheduler()
+        atexit.register(self.scheduler.stop)
+
         self.connector.connect()
         self.login()
 
@@ -59,12 +84,18 @@ class RocketChatBot(OutputChannel):
     """
 
     def send_text_message(self, recipient_id, message):
-        if recipient_id not in self.users:
-            self.users[recipient_id] = RocketchatHandleMessages(
-                recipient_id, self)
+        message_parts = message.split("\n\n")
+        delays = self.typing_policy.delays(message_parts)
+
+        # The paragraphs of concurrent replies to a room are not mixed
+        with self.rooms.hold(recipient_id) as room:
+            for message_part, delay in zip(message_parts, delays):
+                room.add_message(message_part, delay)
 
-        for message_part in message.split("\n\n"):
-            self.users[recipient_id].add_message(message_part)
+    def get_stats(self):
+        stats = self.rooms.get_stats()
+        stats["scheduled_tasks"] = self.scheduler.pending()
+        return stats
 
 
 class RocketChatInput(InputChannel):
@@ -85,12 +116,14 @@ class RocketChatInput(InputChannel):
             credentials.get("server_url"),
         )
 
-    def __init__(self, user, password, server_url):
-        # type: (Text, Text, Text) -> None
+    def __init__(self, user, password, server_url, webhook_mode=WEBHOOK_MODE):
+        # type: (Text, Text, Text, Text) -> None
 
         self.user = user
         self.password = password
         self.server_url = server_url
+        self.webhook_mode = webhook_mode
+        self.webhook_queue = None
 
         self.output_channel = RocketChatBot(
             self.user, self.password, self.server_url)
@@ -107,10 +140,21 @@ class RocketChatInput(InputChannel):
     def blueprint(self, on_new_message):
         rocketchat_webhook = Blueprint("rocketchat_webhook", __name__)
 
+        if self.webhook_mode == "async":
+            self.webhook_queue = WebhookQueue(self.send_message)
+            atexit.register(self.webhook_queue.stop)
+
         @rocketchat_webhook.route("/", methods=["GET"])
         def health():
             return jsonify({"status": "ok"})
 
+        @rocketchat_webhook.route("/stats", methods=["GET"])
+        def stats():
+            stats = self.output_channel.get_stats()
+            if self.webhook_queue is not None:
+                stats["webhook"] = self.webhook_queue.get_stats()
+            return jsonify(stats)
+
         @rocketchat_webhook.route("/webhook", methods=["GET", "POST"])
         def webhook():
             request.get_data()
@@ -127,81 +171,209 @@ class RocketChatInput(InputChannel):
                     sender_name = messages_list[0].get("username", None)
                     recipient_id = output.get("_id")
 
-                self.send_message(text, sender_name,
-                                  recipient_id, on_new_message)
+                if self.webhook_queue is None:
+                    self.send_message(text, sender_name,
+                                      recipient_id, on_new_message)
+                elif sender_name != self.user and not self.webhook_queue.put(
+                        recipient_id, text, sender_name,
+                        recipient_id, on_new_message):
+                    # The integration retries it, see bot_config.py
+                    response = make_response(
+                        jsonify({"status": "busy"}), 503)
+                    response.headers["Retry-After"] = "1"
+                    return response
 
             return make_response()
 
         return rocketchat_webhook
 
 
+class RoomStore:
+    """Outbound state of every room, created on the first reply to the room.
+
+    Rooms neither held nor with queued messages are evicted when they are
+    inactive for longer than idle_timeout or when there are more than
+    max_rooms."""
+
+    def __init__(self, factory, max_rooms=MAX_ROOMS,
+                 idle_timeout=ROOM_IDLE_TIMEOUT):
+        self.factory = factory
+        self.max_rooms = max_rooms
+        self.idle_timeout = idle_timeout
+        self.rooms = OrderedDict()
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    @contextmanager
+    def hold(self, rid):
+        """Yields the locked room, it is not evicted while held."""
+
+        now = time.monotonic()
+
+        with self.lock:
+            room = self.rooms.pop(rid, None)
+            if room is None:
+                room = self.factory(rid)
+            room.last_seen = now
+            room.holders += 1
+            self.rooms[rid] = room
+
+            self.evict(now)
+
+        try:
+            with room.lock:
+                yield room
+        finally:
+            with self.lock:
+                room.holders -= 1
+
+    def evict(self, now):
+        # The first entries are the least recently active rooms, the ones
+        # still sending messages go back to the end
+        for _ in range(len(self.rooms)):
+            rid, room = next(iter(self.rooms.items()))
+            if len(self.rooms) <= self.max_rooms \
+                    and now - room.last_seen <= self.idle_timeout:
+                return
+
+            self.rooms.popitem(last=False)
+            if room.holders or room.pending():
+                self.rooms[rid] = room
+            else:
+                self.evicted += 1
+
+    def get_stats(self):
+        with self.lock:
+            rooms = list(self.rooms.values())
+            evicted = self.evicted
+
+        stats = {
+            "active_rooms": len(rooms),
+            "queued_messages": sum(room.pending() for room in rooms),
+            "evicted_rooms": evicted,
+            "pending_acks": sum(room.pending_acks for room in rooms),
+            "sent_messages": sum(room.sent for room in rooms),
+            "failed_sends": sum(room.failed for room in rooms),
+        }
+
+        # Rooms whose messages take the longest to be acknowledged
+        rooms = sorted((room for room in rooms if room.latency is not None),
+                       key=lambda room: room.latency, reverse=True)
+        stats["slowest_rooms_ms"] = {
+            room.rid: round(room.latency * 1000, 1)
+            for room in rooms[:SLOWEST_ROOMS]
+        }
+        return stats
+
+
 class RocketchatHandleMessages:
+    """Outbound messages of a room, sent in order once they are due.
+
+    Sends are DDP calls made without waiting for the previous ones to be
+    acknowledged, the acknowledgements only update the room stats. The
+    typing indicator is only notified when it changes, once for a burst of
+    messages."""
+
     def __init__(self, rid, bot):
         self.rid = rid
-        self.messages = []
-        self.message_index = 0
+        # Pairs of message and due time, ordered by due time
+        self.messages = deque()
         self.bot = bot
         self.is_typing = False
-
-    def manage_is_typing_message(
-        self, log_message, activate_is_typing, typing_function
-    ):
-        logger.info(log_message)
+        # Due time of the last message scheduled, the next ones go after it
+        self.last_due = 0
+        self.last_seen = time.monotonic()
+        # Threads replying to the room, see RoomStore.hold
+        self.holders = 0
+        # Replies are added by the webhook threads and sent by the scheduler
+        self.lock = threading.RLock()
+
+        self.pending_acks = 0
+        self.sent = 0
+        self.failed = 0
+        # Smoothed time (in seconds) between sending and the acknowledgement
+        self.latency = None
+
+    def pending(self):
+        return len(self.messages)
+
+    def set_typing(self, is_typing):
+        if is_typing == self.is_typing:
+            return
+
+        self.is_typing = is_typing
+        logger.info("{} typing for {}".format(
+            "activate" if is_typing else "deactivate", self.rid))
 
         self.bot.connector.call(
             "stream-notify-room",
-            [self.rid + "/typing", self.bot.username, activate_is_typing],
-            typing_function,
+            [self.rid + "/typing", self.bot.username, is_typing],
+            self.typing_callback,
         )
 
-    def send_message(self):
-        msg = self.messages[self.message_index]
-        self.message_index += 1
-
-        logger.info("[+] send message {}: {}".format(self.rid, msg["message"]))
+    def send_due_messages(self):
+        """Sends every message already due, later tasks scheduled for the
+        messages sent here find nothing to send. Once the scheduler is
+        stopping every queued message is due."""
 
-        self.bot.connector.send_message(self.rid, msg["message"])
+        now = time.monotonic()
+        if not self.bot.scheduler.running:
+            now = float("inf")
 
-        if self.message_index == len(self.messages):
-            if self.is_typing:
-                self.manage_is_typing_message(
-                    "deactivate typing for {}".format(self.rid),
-                    False,
-                    self.deactivate_typing,
-                )
+        with self.lock:
+            while self.messages and self.messages[0][1] <= now:
+                message, _ = self.messages.popleft()
+                self.send_message(message)
 
-            self.messages = []
-            self.message_index = 0
+            if not self.messages:
+                self.set_typing(False)
 
-    def add_message(self, message):
-        if not self.is_typing:
-            self.manage_is_typing_message(
-                "activate typing for {}".format(
-                    self.rid), True, self.activate_typing
-            )
+    def send_message(self, message):
+        logger.info("[+] send message {}: {}".format(self.rid, message))
 
-        wait_time = int(os.getenv("MIN_TYPING_TIME", 1))
-        max_time = int(os.getenv("MAX_TYPING_TIME", 10))
+        started = time.monotonic()
+        self.pending_acks += 1
+        self.bot.connector.call(
+            "sendMessage",
+            [{"rid": self.rid, "msg": message}],
+            lambda error, data: self.send_callback(started, error),
+        )
 
-        if len(self.messages) != 0:
-            last_msg = self.messages[-1]
-            n_words = len(last_msg["message"].split(" "))
+    def add_message(self, message, delay):
+        """Sends message delay seconds after the previous message of the
+        room, or after now if it was already sent."""
 
-            words_per_sec = int(os.getenv("WORDS_PER_SECOND_TYPING", 5))
-            wait_time = (
-                min(max_time, max(1, n_words // words_per_sec)) +
-                last_msg["time"]
-            )
+        with self.lock:
+            if self.bot.typing_policy.shows_typing:
+                self.set_typing(True)
 
-        threading.Timer(wait_time, self.send_message).start()
+            due = max(time.monotonic(), self.last_due) + delay
+            self.messages.append((message, due))
+            self.bot.scheduler.schedule_at(due, self.send_due_messages)
+            self.last_due = due
 
         logger.info("[ ] schedule message {}: {}".format(self.rid, message))
-        self.messages.append({"message": message, "time": wait_time})
 
-    def activate_typing(self, error, data):
-        if not error:
-            self.is_typing = True
+    def send_callback(self, started, error):
+        latency = time.monotonic() - started
 
-    def deactivate_typing(self, error, data):
-        if not error:
-            self.is_typing = False
+        with self.lock:
+            self.pending_acks -= 1
+            if error:
+                self.failed += 1
+            else:
+                self.sent += 1
+
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+
+        if error:
+            logger.error("[-] send message {} failed: {}".format(
+                self.rid, error))
+
+    def typing_callback(self, error, data):
+        if error:
+            logger.error("[-] typing notification {} failed: {}".format(
+                self.rid, error))
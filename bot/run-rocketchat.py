@@ -1,6 +1,7 @@
 import os
 import sys
 import logging
+import threading
 from rasa_core.utils import configure_colored_logging, AvailableEndpoints
 from rasa_core.run import start_server, load_agent
 from rasa_core.interpreter import NaturalLanguageInterpreter
@@ -24,11 +25,26 @@ homedir = os.path.expanduser("/")
 sys.path.append(homedir)
 
 
+class LockedPikaProducer(PikaProducer):
+    """PikaProducer shared by the webhook workers of the async mode, pika
+    connections are not thread safe so events are published one at a
+    time."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+
+    def publish(self, event):
+        with self.lock:
+            super().publish(event)
+
+
 def run(core_dir, nlu_dir):
     pika_broker = None
 
     if ENABLE_ANALYTICS:
-        pika_broker = PikaProducer(url, username, password, queue=queue)
+        pika_broker = LockedPikaProducer(
+            url, username, password, queue=queue)
 
     configs = {
         "user": os.getenv("ROCKETCHAT_BOT_USERNAME"),
@@ -0,0 +1,81 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class MessageScheduler:
+    """Runs the delayed sends of every room in a single thread.
+
+    Tasks are kept in a heap ordered by due time, tasks due at the same time
+    run in the order they were scheduled."""
+
+    def __init__(self):
+        self.tasks = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.thread = threading.Thread(
+            target=self.run, name="message-scheduler", daemon=True)
+        self.thread.start()
+
+    def schedule_at(self, due, function, *args):
+        """Runs function at the time.monotonic() due."""
+
+        with self.condition:
+            if not self.running:
+                raise RuntimeError("scheduler is stopped")
+
+            task = (due, next(self.counter), function, args)
+            heapq.heappush(self.tasks, task)
+            # Wakes the thread only when the new task is the next one
+            if self.tasks[0] is task:
+                self.condition.notify()
+
+    def schedule(self, delay, function, *args):
+        due = time.monotonic() + delay
+        self.schedule_at(due, function, *args)
+        return due
+
+    def pending(self):
+        with self.condition:
+            return len(self.tasks)
+
+    def next_task(self):
+        with self.condition:
+            while True:
+                if not self.tasks:
+                    if not self.running:
+                        return None
+                    self.condition.wait()
+                    continue
+
+                delay = self.tasks[0][0] - time.monotonic()
+                if delay <= 0 or not self.running:
+                    return heapq.heappop(self.tasks)
+                self.condition.wait(delay)
+
+    def run(self):
+        while True:
+            task = self.next_task()
+            if task is None:
+                return
+
+            _, _, function, args = task
+            try:
+                function(*args)
+            except Exception:
+                logger.exception("Scheduled task {} failed".format(function))
+
+    def stop(self, timeout=None):
+        """Runs the pending tasks right away, in order, and waits for the
+        thread to finish."""
+
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(timeout)
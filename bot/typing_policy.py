@@ -0,0 +1,105 @@
+import os
+from abc import ABC, abstractmethod
+
+# "none", "fixed", "wps" (words per second) or "cps" (characters per second)
+TYPING_STRATEGY = os.getenv("TYPING_STRATEGY", "wps")
+MIN_TYPING_TIME = float(os.getenv("MIN_TYPING_TIME", 1))
+MAX_TYPING_TIME = float(os.getenv("MAX_TYPING_TIME", 10))
+FIXED_TYPING_TIME = float(os.getenv("FIXED_TYPING_TIME", 1))
+WORDS_PER_SECOND_TYPING = float(os.getenv("WORDS_PER_SECOND_TYPING", 5))
+CHARACTERS_PER_SECOND_TYPING = float(
+    os.getenv("CHARACTERS_PER_SECOND_TYPING", 25))
+# Longest time (in seconds) spent typing all the paragraphs of a reply,
+# 0 for no limit
+MAX_REPLY_TYPING_TIME = float(os.getenv("MAX_REPLY_TYPING_TIME", 0))
+
+
+class TypingPolicy(ABC):
+    """Time the bot spends typing each paragraph of a reply before sending
+    it. The delays of a reply are scaled down to fit max_reply_time."""
+
+    # Whether the typing indicator is shown while waiting
+    shows_typing = True
+
+    def __init__(self, max_reply_time=MAX_REPLY_TYPING_TIME):
+        self.max_reply_time = max_reply_time
+
+    @abstractmethod
+    def delay(self, message):
+        """Seconds spent typing message."""
+
+    def delays(self, messages):
+        delays = [self.delay(message) for message in messages]
+
+        total = sum(delays)
+        if self.max_reply_time and total > self.max_reply_time:
+            delays = [d * self.max_reply_time / total for d in delays]
+        return delays
+
+
+class NoTyping(TypingPolicy):
+    shows_typing = False
+
+    def delay(self, message):
+        return 0
+
+
+class FixedTyping(TypingPolicy):
+    def __init__(self, seconds=FIXED_TYPING_TIME, **kwargs):
+        super().__init__(**kwargs)
+        self.seconds = seconds
+
+    def delay(self, message):
+        return self.seconds
+
+
+class RateTyping(TypingPolicy):
+    """Types length(message) units at rate units per second, between
+    min_time and max_time."""
+
+    def __init__(self, rate, min_time=MIN_TYPING_TIME,
+                 max_time=MAX_TYPING_TIME, **kwargs):
+        super().__init__(**kwargs)
+        self.rate = rate
+        self.min_time = min_time
+        self.max_time = max_time
+
+    @abstractmethod
+    def length(self, message):
+        """Units of message typed at rate."""
+
+    def delay(self, message):
+        seconds = self.length(message) / self.rate
+        return min(self.max_time, max(self.min_time, seconds))
+
+
+class WordsPerSecondTyping(RateTyping):
+    def __init__(self, rate=WORDS_PER_SECOND_TYPING, **kwargs):
+        super().__init__(rate, **kwargs)
+
+    def length(self, message):
+        return len(message.split())
+
+
+class CharactersPerSecondTyping(RateTyping):
+    def __init__(self, rate=CHARACTERS_PER_SECOND_TYPING, **kwargs):
+        super().__init__(rate, **kwargs)
+
+    def length(self, message):
+        return len(message)
+
+
+STRATEGIES = {
+    "none": NoTyping,
+    "fixed": FixedTyping,
+    "wps": WordsPerSecondTyping,
+    "cps": CharactersPerSecondTyping,
+}
+
+
+def create_typing_policy(strategy=TYPING_STRATEGY):
+    if strategy not in STRATEGIES:
+        raise ValueError("Unknown typing strategy {}, use one of {}".format(
+            strategy, ", ".join(STRATEGIES)))
+
+    return STRATEGIES[strategy]()
@@ -0,0 +1,80 @@
+import logging
+import os
+import queue
+import threading
+import zlib
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_WORKERS = int(os.getenv("ROCKETCHAT_WEBHOOK_WORKERS", 8))
+# Messages waiting for each worker, the webhook answers 503 past this
+WEBHOOK_QUEUE_SIZE = int(os.getenv("ROCKETCHAT_WEBHOOK_QUEUE_SIZE", 100))
+
+
+class WebhookQueue:
+    """Handles the user messages received by the webhook in a pool of
+    worker threads, so the request returns before the bot answers.
+
+    Every recipient has its messages handled by the same worker, in the
+    order they arrived."""
+
+    def __init__(self, handler, workers=WEBHOOK_WORKERS,
+                 max_size=WEBHOOK_QUEUE_SIZE):
+        self.handler = handler
+        self.queues = [queue.Queue(maxsize=max_size) for _ in range(workers)]
+        self.lock = threading.Lock()
+        self.stats = {"accepted": 0, "rejected": 0, "failed": 0}
+
+        self.threads = [
+            threading.Thread(target=self.run, args=(q,), daemon=True,
+                             name="webhook-worker-{}".format(i))
+            for i, q in enumerate(self.queues)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def queue_of(self, recipient_id):
+        index = zlib.crc32(str(recipient_id).encode("utf-8"))
+        return self.queues[index % len(self.queues)]
+
+    def put(self, recipient_id, *args):
+        """Returns False when the queue of the recipient is full."""
+
+        try:
+            self.queue_of(recipient_id).put_nowait(args)
+        except queue.Full:
+            self.count("rejected")
+            return False
+
+        self.count("accepted")
+        return True
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def run(self, messages):
+        while True:
+            args = messages.get()
+            if args is None:
+                return
+
+            try:
+                self.handler(*args)
+            except Exception:
+                self.count("failed")
+                logger.exception("Failed to handle webhook message")
+
+    def stop(self, timeout=None):
+        """Handles the messages already queued and stops the workers."""
+
+        for messages in self.queues:
+            messages.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["queued"] = sum(q.qsize() for q in self.queues)
+        return stats
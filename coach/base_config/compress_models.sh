@@ -2,3 +2,6 @@
 tar -czvf models.tar.gz /src_models/
 
 md5sum models.tar.gz > model_version.txt
+
+python3 /scripts/model_manifest.py /src_models/ \
+    --objects /model_files --manifest /model_manifest.json
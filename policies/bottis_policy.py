@@ -1,8 +1,7 @@
 import json
 import logging
 import os
-import uuid
-import pika
+import threading
 from typing import Optional, Any, Dict, List, Text
 from rasa_core import utils
 from rasa_core.domain import Domain
@@ -12,6 +11,8 @@ from rasa_core.policies.policy import Policy
 from rasa_core.trackers import DialogueStateTracker
 from rasa_core.actions.action import ACTION_LISTEN_NAME
 
+from policies.rpc_client import UnionRPCClient
+
 
 logger = logging.getLogger(__name__)
 
@@ -26,21 +27,18 @@ class BottisPolicy(Policy):
         featurizer: Optional[TrackerFeaturizer] = None,
         max_history: Optional[int] = None,
         lookup: Optional[Dict] = None,
+        rpc_timeout: float = 7.0,
     ) -> None:
 
         self.custom_response_action_name = custom_response_action_name
+        self.rpc_timeout = rpc_timeout
         self.core_threshold = core_threshold
         self.nlu_threshold = nlu_threshold
         self.priority = priority
         super(BottisPolicy, self).__init__(featurizer, priority)
 
-        # Flag to verify if rabbitmq is connected or needs to be initialized
-        self.connected = False
-
-    def on_response(self, ch, method, props, body):
-        if self.corr_id == props.correlation_id:
-            self.response = body
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+        self.connect_lock = threading.Lock()
+        self.rpc_client = None
 
     def train(
         self,
@@ -59,20 +57,12 @@ class BottisPolicy(Policy):
         return result
 
     def call(self, text):
-        self.response = None
+        """Asks the union server for an answer. Returns None if it does not
+        answer within `rpc_timeout` seconds, which must be longer than the
+        union's UNION_ASK_TIMEOUT to get its partial answers."""
+
         bot_message = {"bot_message": text, "bot_name": self.bot_name}
-        self.corr_id = str(uuid.uuid4())
-        self.channel.basic_publish(
-            exchange="",
-            routing_key="rpc_queue",
-            properties=pika.BasicProperties(
-                reply_to=self.callback_queue, correlation_id=self.corr_id
-            ),
-            body=json.dumps(bot_message),
-        )
-        while self.response is None:
-            self.connection.process_data_events()
-        return json.loads(self.response)
+        return self.rpc_client.call(bot_message, self.rpc_timeout)
 
     def predict_action_probabilities(
         self, tracker: DialogueStateTracker, domain: Domain
@@ -80,9 +70,8 @@ class BottisPolicy(Policy):
         """Predicts the next action the bot should take
         after seeing the tracker.
         Returns the list of probabilities for the next actions"""
-        if not self.connected:
-            # TODO: connection seems to expire,
-            # if expired we should set connected to false again.
+        if self.rpc_client is None:
+            # Only starts the client, call() waits up to rpc_timeout for it
             self.connect_to_rabbit()
 
         result = [0.0] * domain.num_actions
@@ -99,6 +88,9 @@ class BottisPolicy(Policy):
             text = tracker.latest_message.text or ""
 
             answer = self.call(text)
+            if answer is None:
+                # Let the other policies predict the next action
+                return result
 
             logger.info("\n\n -- Answer Selected -- ")
             logger.info("Bot: " + answer["bot"])
@@ -124,33 +116,32 @@ class BottisPolicy(Policy):
             "nlu_threshold": self.nlu_threshold,
             "core_threshold": self.core_threshold,
             "custom_response_action_name": self.custom_response_action_name,
+            "rpc_timeout": self.rpc_timeout,
         }
         utils.create_dir_for_file(config_file)
         utils.dump_obj_as_json_to_file(config_file, meta)
 
-    def connect_to_rabbit(self):
-        username = os.getenv("RABBITMQ_DEFAULT_USER")
-        password = os.getenv("RABBITMQ_DEFAULT_PASS")
-        broker_url = os.getenv("BROKER_URL")
-
-        self.bot_name = os.getenv("BOT_NAME")
+    def connect_to_rabbit(self, timeout=0):
+        """Starts the union RPC client, which keeps reconnecting in the
+        background if the broker is not available, and waits up to
+        `timeout` seconds for its first connection."""
 
-        credentials = pika.PlainCredentials(username, password)
+        with self.connect_lock:
+            if self.rpc_client is not None:
+                return
 
-        self.connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host=broker_url, credentials=credentials)
-        )
+            self.bot_name = os.getenv("BOT_NAME")
 
-        self.channel = self.connection.channel()
+            self.rpc_client = UnionRPCClient(
+                broker_url=os.getenv("BROKER_URL"),
+                username=os.getenv("RABBITMQ_DEFAULT_USER"),
+                password=os.getenv("RABBITMQ_DEFAULT_PASS"),
+                heartbeat=int(os.getenv("BROKER_HEARTBEAT", 30)),
+            )
+            self.rpc_client.connect(0)
 
-        result = self.channel.queue_declare(queue="", exclusive=True)
-        self.callback_queue = result.method.queue
-
-        self.channel.basic_consume(
-            queue=self.callback_queue, on_message_callback=self.on_response
-        )
-
-        self.connected = True
+        if timeout and not self.rpc_client.connect(timeout):
+            logger.warning("Union broker not available yet, retrying")
 
     @classmethod
     def load(cls, path: Text) -> "BottisPolicy":
@@ -161,4 +152,8 @@ class BottisPolicy(Policy):
             if os.path.isfile(meta_path):
                 meta = json.loads(utils.read_file(meta_path))
 
-        return cls(**meta)
+        policy = cls(**meta)
+        # Warm the broker connection before the first prediction
+        policy.connect_to_rabbit(timeout=policy.rpc_timeout)
+
+        return policy
@@ -0,0 +1,191 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent import futures
+from functools import partial
+
+import pika
+
+logger = logging.getLogger(__name__)
+
+
+class UnionRPCClient:
+    """RPC client for the union server shared by every conversation.
+
+    The broker connection is owned by a single I/O thread. Callers publish
+    through it with `add_callback_threadsafe` and wait on a future bound to
+    their correlation id, so many requests can be in flight at once.
+
+    The I/O thread keeps the connection alive with heartbeats and opens a
+    new one, with a new callback queue, whenever the broker link dies."""
+
+    def __init__(
+        self,
+        broker_url,
+        username,
+        password,
+        queue="rpc_queue",
+        heartbeat=30,
+        max_reconnect_delay=30,
+    ):
+        self.queue = queue
+        self.parameters = pika.ConnectionParameters(
+            host=broker_url,
+            credentials=pika.PlainCredentials(username, password),
+            heartbeat=heartbeat,
+            blocked_connection_timeout=heartbeat,
+        )
+        self.max_reconnect_delay = max_reconnect_delay
+
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stats = {
+            "rpc_calls": 0,
+            "rpc_timeouts": 0,
+            "rpc_failures": 0,
+            "connection_errors": 0,
+            "reconnects": 0,
+        }
+
+        self.connection = None
+        self.channel = None
+        self.callback_queue = None
+        self.ready = threading.Event()
+        self.thread = None
+
+    def connect(self, timeout=None):
+        """Starts the I/O thread and waits up to `timeout` seconds for the
+        first connection. Returns whether the client is connected."""
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+        return self.ready.wait(timeout)
+
+    def open_connection(self):
+        connection = pika.BlockingConnection(self.parameters)
+        channel = connection.channel()
+
+        # The callback queue is exclusive, it dies with the connection
+        result = channel.queue_declare(queue="", exclusive=True)
+        channel.basic_consume(
+            queue=result.method.queue, on_message_callback=self.on_response
+        )
+
+        self.connection = connection
+        self.channel = channel
+        self.callback_queue = result.method.queue
+        self.ready.set()
+
+    def on_connection_lost(self, exc):
+        self.ready.clear()
+        self.connection = None
+
+        with self.lock:
+            self.stats["connection_errors"] += 1
+            pending = list(self.pending.values())
+            self.pending = {}
+
+        # Answers to the old callback queue are lost, fail those calls now
+        for future in pending:
+            future.set_exception(exc)
+
+    def run(self):
+        delay = 1
+        connected_before = False
+
+        while True:
+            try:
+                if self.connection is None:
+                    self.open_connection()
+                    if connected_before:
+                        with self.lock:
+                            self.stats["reconnects"] += 1
+                        logger.warning("Reconnected to the broker")
+                    connected_before = True
+                    delay = 1
+
+                self.connection.process_data_events(time_limit=1)
+            except pika.exceptions.AMQPError as exc:
+                logger.warning(
+                    "Broker connection lost: {!r}. Retrying in {}s".format(
+                        exc, delay)
+                )
+                self.on_connection_lost(exc)
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+    def on_response(self, ch, method, props, body):
+        with self.lock:
+            future = self.pending.pop(props.correlation_id, None)
+
+        # Late answers of timed out calls are dropped
+        if future is not None:
+            future.set_result(body)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def publish(self, corr_id, body):
+        self.channel.basic_publish(
+            exchange="",
+            routing_key=self.queue,
+            properties=pika.BasicProperties(
+                reply_to=self.callback_queue, correlation_id=corr_id
+            ),
+            body=body,
+        )
+
+    def call(self, message, timeout):
+        """Sends the message to the union server and waits for its answer.
+        Returns None if it does not answer within `timeout` seconds or the
+        broker is unavailable."""
+
+        deadline = time.monotonic() + timeout
+        corr_id = str(uuid.uuid4())
+        future = futures.Future()
+
+        with self.lock:
+            self.stats["rpc_calls"] += 1
+
+        try:
+            if not self.ready.wait(timeout):
+                raise futures.TimeoutError()
+
+            with self.lock:
+                self.pending[corr_id] = future
+
+            connection = self.connection
+            if connection is None:
+                raise pika.exceptions.AMQPConnectionError("Not connected")
+
+            connection.add_callback_threadsafe(
+                partial(self.publish, corr_id, json.dumps(message))
+            )
+
+            remaining = max(deadline - time.monotonic(), 0)
+            return json.loads(future.result(timeout=remaining))
+        except futures.TimeoutError:
+            counter = "rpc_timeouts"
+        except pika.exceptions.AMQPError as exc:
+            logger.warning("Could not call the union server: {!r}".format(
+                exc))
+            counter = "rpc_failures"
+
+        with self.lock:
+            self.pending.pop(corr_id, None)
+            self.stats[counter] += 1
+            stats = dict(self.stats)
+
+        logger.warning(
+            "Union server did not answer in {}s, {} of {} calls timed out, "
+            "{} failed".format(
+                timeout,
+                stats["rpc_timeouts"],
+                stats["rpc_calls"],
+                stats["rpc_failures"],
+            )
+        )
+
+        return None
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""Load generator for the sharded analytics consumer.
+
+Fills bot_messages with synthetic conversations on a local RabbitMQ
+(BROKER_URL). It first runs the router alone, to measure how fast it fills
+the shard queues, which bounds the throughput of any number of workers.
+Then it runs the router with 1, 2, 4... worker processes and prints the
+messages/second of each run. Elasticsearch is replaced by a stub that waits
+--index-ms for every bulk request, so the numbers show how the consumers
+scale and not how fast the cluster is."""
+import argparse
+import json
+import multiprocessing
+import time
+
+import consume_bot_messages as consumer
+
+
+class StubConnector:
+    def __init__(self, indexed, index_ms, bulk_size):
+        self.indexed = indexed
+        self.index_ms = index_ms
+        self.bulk_size = bulk_size
+        self.docs = 0
+        self.last_flush = time.monotonic()
+
+    def save_user_message(self, message):
+        self.docs += 1
+
+    def save_bot_message(self, bot_message, action_message, user_message):
+        self.docs += 1
+
+    def should_flush(self):
+        return (self.docs >= self.bulk_size
+                or time.monotonic() - self.last_flush >= 0.5)
+
+    def flush(self):
+        time.sleep(self.index_ms / 1000)
+        with self.indexed.get_lock():
+            self.indexed.value += self.docs
+        self.docs = 0
+        self.last_flush = time.monotonic()
+        return True
+
+    def update_summaries(self, force=False):
+        return True
+
+
+def run_worker(shard, indexed, index_ms, bulk_size, prefetch):
+    consumer.BotMessagesConsumer(
+        consumer.connect(),
+        "{}.{}".format(consumer.QUEUE_NAME, shard),
+        StubConnector(indexed, index_ms, bulk_size),
+        prefetch=prefetch,
+    ).start()
+
+
+def publish_conversations(channel, turns, senders):
+    for turn in range(turns):
+        sender_id = "bench-{}".format(turn % senders)
+        events = [
+            {"event": "user", "sender_id": sender_id, "text": "oi",
+             "timestamp": time.time(),
+             "parse_data": {"intent": {"name": "cumprimentar",
+                                       "confidence": 0.9},
+                            "entities": []}},
+            {"event": "action", "sender_id": sender_id,
+             "name": "utter_cumprimentar", "timestamp": time.time()},
+            {"event": "bot", "sender_id": sender_id, "text": "Olá!",
+             "timestamp": time.time()},
+        ]
+        for event in events:
+            channel.basic_publish(
+                exchange="", routing_key=consumer.QUEUE_NAME,
+                body=json.dumps(event))
+
+
+def reset_queues(channel, max_shards):
+    channel.queue_declare(queue=consumer.QUEUE_NAME, durable=True)
+    channel.queue_purge(queue=consumer.QUEUE_NAME)
+    for shard in range(max_shards):
+        channel.queue_delete(queue="{}.{}".format(consumer.QUEUE_NAME, shard))
+
+
+def shard_messages(channel, shards):
+    return sum(
+        channel.queue_declare(
+            queue="{}.{}".format(consumer.QUEUE_NAME, shard), durable=True,
+            passive=True).method.message_count
+        for shard in range(shards)
+    )
+
+
+def bench_router(args):
+    shards = max(args.workers)
+    connection = consumer.connect()
+    channel = connection.channel()
+    reset_queues(channel, shards)
+    publish_conversations(channel, args.turns, args.senders)
+
+    expected = 3 * args.turns
+    router = multiprocessing.Process(
+        target=consumer.route_messages,
+        args=(shards, args.prefetch, args.router_batch))
+
+    start = time.monotonic()
+    router.start()
+    while True:
+        time.sleep(0.05)
+        try:
+            if shard_messages(channel, shards) >= expected:
+                break
+        except Exception:
+            # The router has not declared the shard queues yet
+            channel = connection.channel()
+    elapsed = time.monotonic() - start
+
+    router.terminate()
+    router.join()
+    connection.close()
+
+    print("{:>11}: {:>9.0f} messages/s ({:.2f}s)".format(
+        "router", expected / elapsed, elapsed))
+
+
+def bench(workers, args):
+    connection = consumer.connect()
+    channel = connection.channel()
+    reset_queues(channel, max(args.workers))
+    publish_conversations(channel, args.turns, args.senders)
+    connection.close()
+
+    expected = 2 * args.turns
+    indexed = multiprocessing.Value("i", 0)
+    processes = [multiprocessing.Process(
+        target=consumer.route_messages,
+        args=(workers, args.prefetch, args.router_batch))]
+    processes += [
+        multiprocessing.Process(
+            target=run_worker,
+            args=(shard, indexed, args.index_ms, args.bulk_size,
+                  args.prefetch),
+        )
+        for shard in range(workers)
+    ]
+
+    start = time.monotonic()
+    for process in processes:
+        process.start()
+    while indexed.value < expected:
+        time.sleep(0.05)
+    elapsed = time.monotonic() - start
+
+    for process in processes:
+        process.terminate()
+        process.join()
+
+    print("{:>3} workers: {:>9.0f} messages/s ({:.2f}s)".format(
+        workers, 3 * args.turns / elapsed, elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="benchmarks the sharded analytics consumer")
+    parser.add_argument("--turns", type=int, default=10000,
+                        help="conversation turns, each one has 3 events")
+    parser.add_argument("--senders", type=int, default=500)
+    parser.add_argument("--workers", type=lambda s: [
+                        int(n) for n in s.split(",")], default=[1, 2, 4])
+    parser.add_argument("--index-ms", type=float, default=20,
+                        help="time spent by each bulk request")
+    parser.add_argument("--bulk-size", type=int, default=500)
+    parser.add_argument("--prefetch", type=int, default=1000)
+    parser.add_argument("--router-batch", type=int,
+                        default=consumer.ROUTER_BATCH)
+    args = parser.parse_args()
+
+    bench_router(args)
+    for workers in args.workers:
+        bench(workers, args)
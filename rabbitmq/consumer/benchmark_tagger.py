@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Micro-benchmark of the per-message cost of extracting the tags of a user
+message, comparing the Tagger with the previous inline implementation."""
+import argparse
+import timeit
+
+import stopwords
+from tagger import Tagger
+
+MESSAGES = [
+    "Oi, tudo bem?",
+    "Eu queria saber como faço para abrir uma empresa (MEI) no Brasil",
+    'O que é "Lei Rouanet"? E como posso usar para o meu projeto *cultural*',
+    "Bom dia. Qual o horário de funcionamento da defensoria, por favor",
+]
+
+
+def legacy_tags(text):
+    tags = []
+    for word in (
+        text
+        .replace(". ", " ")
+        .replace(",", " ")
+        .replace('"', "")
+        .replace("'", "")
+        .replace("*", "")
+        .replace("(", "")
+        .replace(")", "")
+        .split(" ")
+    ):
+
+        # Rebuilt for every word like the NLTK corpus list was, without
+        # needing the corpus downloaded
+        if (word.lower() not in list(stopwords.PORTUGUESE)
+                and len(word) > 1):
+            tags.append(word)
+    return tags
+
+
+def bench(name, function, number):
+    seconds = timeit.timeit(
+        lambda: [function(m) for m in MESSAGES], number=number)
+    per_message = seconds / (number * len(MESSAGES)) * 1e6
+    print("{:<28} {:>10.2f} us/message".format(name, per_message))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmarks message tags")
+    parser.add_argument("--number", "-n", type=int, default=2000)
+    args = parser.parse_args()
+
+    bench("legacy", legacy_tags, max(args.number // 100, 1))
+    bench("tagger", Tagger().tags, args.number)
+    bench("tagger (strip accents)",
+          Tagger(strip_accents=True).tags, args.number)
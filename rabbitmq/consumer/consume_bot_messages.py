@@ -3,23 +3,50 @@ import pika
 import os
 import json
 import logging
-from elastic_connector import ElasticConnector
+import multiprocessing
+import zlib
+from elastic_connector import ElasticConnector, BULK_SIZE, FLUSH_INTERVAL
+from conversation_state import ConversationPairer
 
 username = os.getenv("RABBITMQ_DEFAULT_USER")
-password = os.getenv("RABBITMQ_DEFAULT_USER")
+password = os.getenv("RABBITMQ_DEFAULT_PASS")
 credentials = pika.PlainCredentials(username, password)
+broker_url = os.getenv("BROKER_URL", "rabbitmq")
 
 logger = logging.getLogger(__name__)
 
-_elastic_connector = None
+QUEUE_NAME = "bot_messages"
+# "single" consumes the bot_messages queue in one process.
+# "sharded" runs a router and one worker process per shard.
+# "router" and "worker" run only one of those parts, e.g. in
+# separate containers.
+CONSUMER_MODE = os.getenv("CONSUMER_MODE", "single")
+SHARDS = int(os.getenv("ANALYTICS_SHARDS", 1))
+# Shard consumed in "worker" mode
+SHARD = int(os.getenv("ANALYTICS_SHARD", 0))
+# Unacked messages each consumer holds, at least a batch to index
+PREFETCH = int(os.getenv("ANALYTICS_PREFETCH", 2 * BULK_SIZE))
+# Messages the router moves to the shard queues in each transaction, and
+# the longest time (in seconds) a smaller batch waits to be committed
+ROUTER_BATCH = int(os.getenv("ANALYTICS_ROUTER_BATCH", 200))
+ROUTER_COMMIT_INTERVAL = float(
+    os.getenv("ANALYTICS_ROUTER_COMMIT_INTERVAL", 0.2))
+
+
+def create_elastic_connector():
+    connector = new_elastic_connector()
+    connector.wait_for_index()
+    return connector
+
+
+def new_elastic_connector():
+    elastic_user = os.getenv("ELASTICSEARCH_USER")
+    if elastic_user is None:
+        return ElasticConnector(
+            domain=os.getenv("ELASTICSEARCH_URL", "elasticsearch:9200")
+        )
 
-elastic_user = os.getenv("ELASTICSEARCH_USER")
-if elastic_user is None:
-    _elastic_connector = ElasticConnector(
-        domain=os.getenv("ELASTICSEARCH_URL", "elasticsearch:9200")
-    )
-else:
-    _elastic_connector = ElasticConnector(
+    return ElasticConnector(
         domain=os.getenv("ELASTICSEARCH_URL", "elasticsearch:9200"),
         user=os.getenv("ELASTICSEARCH_USER", "user"),
         password=os.getenv("ELASTICSEARCH_PASSWORD", "password"),
@@ -27,53 +54,172 @@ else:
         scheme_port=os.getenv("ELASTICSEARCH_PORT", "80"),
     )
 
-connection = pika.BlockingConnection(
-    pika.ConnectionParameters(
-        host="rabbitmq",
-        credentials=credentials,
-        connection_attempts=20,
-        retry_delay=5
+
+def connect():
+    return pika.BlockingConnection(
+        pika.ConnectionParameters(
+            host=broker_url,
+            credentials=credentials,
+            connection_attempts=20,
+            retry_delay=5
+        )
     )
-)
 
-channel = connection.channel()
-channel.queue_declare(queue="bot_messages", durable=True)
 
+def shard_of(sender_id, shards):
+    """Shard holding every event of the sender, so the events of a
+    conversation are consumed in order by one worker."""
 
-def callback(ch, method, properties, body):
-    logger.warning(" [x] Received %r" % body)
+    return zlib.crc32(str(sender_id).encode("utf-8")) % shards
 
-    message = json.loads(body.decode("utf-8"))
 
-    if message["event"] == "user":
-        _elastic_connector.save_user_message(message)
-        _elastic_connector.previous_user_message = message
+def shard_queue(sender_id, shards):
+    return "{}.{}".format(QUEUE_NAME, shard_of(sender_id, shards))
 
-    elif message["event"] == "action":
-        if message["name"] == "action_listen":
-            _elastic_connector.previous_action = None
-            return
 
-        _elastic_connector.previous_action = message
+class BotMessagesConsumer:
+    def __init__(self, connection, queue, elastic_connector,
+                 prefetch=PREFETCH):
+        self.connection = connection
+        self.channel = connection.channel()
+        self.channel.queue_declare(queue=queue, durable=True)
+        self.queue = queue
+        self.prefetch = prefetch
 
-    elif message["event"] == "bot":
-        if _elastic_connector.previous_action is None:
-            _elastic_connector.previous_user_message = None
-            return
+        self.elastic_connector = elastic_connector
+        self.pairer = ConversationPairer(elastic_connector)
+
+        # Messages are acked only after the batch holding them is indexed
+        self.last_delivery_tag = None
 
-        bot_message = message
-        action_message = _elastic_connector.previous_action
-        previous_user_message = _elastic_connector.previous_user_message
+    def flush_and_ack(self):
+        if self.last_delivery_tag is None:
+            return
 
-        _elastic_connector.save_bot_message(
-            bot_message, action_message, previous_user_message
+        if self.elastic_connector.flush():
+            self.channel.basic_ack(
+                delivery_tag=self.last_delivery_tag, multiple=True)
+        else:
+            self.channel.basic_nack(
+                delivery_tag=self.last_delivery_tag, multiple=True,
+                requeue=True)
+
+        self.last_delivery_tag = None
+
+    def periodic_flush(self):
+        self.flush_and_ack()
+        self.elastic_connector.update_summaries()
+        self.connection.call_later(FLUSH_INTERVAL, self.periodic_flush)
+
+    def callback(self, ch, method, properties, body):
+        logger.debug(" [x] Received %r" % body)
+
+        try:
+            message = json.loads(body.decode("utf-8"))
+            self.pairer.handle(message)
+        except Exception:
+            # Acked with the batch, redelivering it would fail the same way
+            logger.exception("Could not handle event {!r}".format(body))
+
+        self.last_delivery_tag = method.delivery_tag
+        if self.elastic_connector.should_flush():
+            self.flush_and_ack()
+
+    def start(self):
+        self.channel.basic_qos(prefetch_count=self.prefetch)
+        self.channel.basic_consume(
+            queue=self.queue, on_message_callback=self.callback)
+        self.connection.call_later(FLUSH_INTERVAL, self.periodic_flush)
+
+        logger.warning("[*] Waiting for messages on {}.".format(self.queue))
+        self.channel.start_consuming()
+
+
+def route_messages(shards=SHARDS, prefetch=PREFETCH, batch=ROUTER_BATCH):
+    """Moves the events of bot_messages to the queue of their shard.
+
+    Publishes and acks are committed in transactions of up to batch
+    messages: the broker has the events on the shard queues once the ack of
+    bot_messages is committed, with one round trip for the whole batch."""
+
+    connection = connect()
+    channel = connection.channel()
+    channel.queue_declare(queue=QUEUE_NAME, durable=True)
+    for shard in range(shards):
+        channel.queue_declare(
+            queue="{}.{}".format(QUEUE_NAME, shard), durable=True)
+
+    channel.tx_select()
+    pending = {"count": 0, "delivery_tag": None}
+
+    def commit():
+        if pending["delivery_tag"] is not None:
+            channel.basic_ack(
+                delivery_tag=pending["delivery_tag"], multiple=True)
+            channel.tx_commit()
+        pending["count"] = 0
+        pending["delivery_tag"] = None
+
+    def periodic_commit():
+        commit()
+        connection.call_later(ROUTER_COMMIT_INTERVAL, periodic_commit)
+
+    def on_message(ch, method, properties, body):
+        try:
+            routing_key = shard_queue(
+                json.loads(body.decode("utf-8")).get("sender_id"), shards)
+        except (ValueError, AttributeError):
+            # The worker of the first shard logs and acks it
+            logger.error("Invalid event {!r}".format(body))
+            routing_key = "{}.0".format(QUEUE_NAME)
+
+        ch.basic_publish(
+            exchange="",
+            routing_key=routing_key,
+            body=body,
+            properties=pika.BasicProperties(delivery_mode=2),
         )
 
+        pending["count"] += 1
+        pending["delivery_tag"] = method.delivery_tag
+        if pending["count"] >= batch:
+            commit()
 
-if __name__ == "__main__":
-    channel.basic_consume(
-        queue="bot_messages", on_message_callback=callback, auto_ack=True
-    )
+    channel.basic_qos(prefetch_count=max(prefetch, batch))
+    channel.basic_consume(queue=QUEUE_NAME, on_message_callback=on_message)
+    connection.call_later(ROUTER_COMMIT_INTERVAL, periodic_commit)
 
-    logger.warning("[*] Waiting for messages.")
+    logger.warning("[*] Routing messages to {} shards.".format(shards))
     channel.start_consuming()
+
+
+def consume(queue=QUEUE_NAME):
+    BotMessagesConsumer(connect(), queue, create_elastic_connector()).start()
+
+
+def consume_shard(shard):
+    consume("{}.{}".format(QUEUE_NAME, shard))
+
+
+def run_sharded(shards=SHARDS):
+    processes = [multiprocessing.Process(target=route_messages)]
+    processes += [
+        multiprocessing.Process(target=consume_shard, args=(shard,))
+        for shard in range(shards)
+    ]
+
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    if CONSUMER_MODE == "sharded":
+        run_sharded()
+    elif CONSUMER_MODE == "router":
+        route_messages()
+    elif CONSUMER_MODE == "worker":
+        consume_shard(SHARD)
+    else:
+        consume()
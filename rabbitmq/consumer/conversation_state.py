@@ -0,0 +1,86 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Conversations kept in memory, the least recently active are evicted
+MAX_SENDERS = int(os.getenv("ANALYTICS_MAX_SENDERS", 10000))
+# Time (in seconds) after which an inactive conversation is forgotten
+SENDER_IDLE_TIMEOUT = float(os.getenv("ANALYTICS_SENDER_IDLE_TIMEOUT", 3600))
+
+
+class ConversationState:
+    __slots__ = ("previous_action", "previous_user_message", "last_seen",
+                 "lock")
+
+    def __init__(self):
+        self.previous_action = None
+        self.previous_user_message = None
+        self.last_seen = time.monotonic()
+        self.lock = threading.Lock()
+
+
+class ConversationPairer:
+    """Pairs bot messages with the action and the user message that caused
+    them, keeping a separate state for every sender so interleaved
+    conversations do not mix."""
+
+    def __init__(self, connector, max_senders=MAX_SENDERS,
+                 idle_timeout=SENDER_IDLE_TIMEOUT):
+        self.connector = connector
+        self.max_senders = max_senders
+        self.idle_timeout = idle_timeout
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_state(self, sender_id):
+        now = time.monotonic()
+
+        with self.lock:
+            state = self.states.pop(sender_id, None)
+            if state is None:
+                state = ConversationState()
+            state.last_seen = now
+            self.states[sender_id] = state
+
+            # The first entries are the least recently active senders
+            while self.states and (
+                len(self.states) > self.max_senders
+                or now - next(iter(self.states.values())).last_seen
+                > self.idle_timeout
+            ):
+                self.states.popitem(last=False)
+
+        return state
+
+    def handle(self, message):
+        state = self.get_state(message.get("sender_id"))
+
+        with state.lock:
+            if message["event"] == "user":
+                self.connector.save_user_message(message)
+                state.previous_user_message = message
+
+            elif message["event"] == "action":
+                if message["name"] == "action_listen":
+                    state.previous_action = None
+                    return
+
+                state.previous_action = message
+
+            elif message["event"] == "bot":
+                if state.previous_action is None:
+                    state.previous_user_message = None
+                    return
+
+                if state.previous_user_message is None:
+                    # The user message was evicted or never consumed
+                    return
+
+                self.connector.save_bot_message(
+                    message, state.previous_action,
+                    state.previous_user_message
+                )
+
+    def __len__(self):
+        return len(self.states)
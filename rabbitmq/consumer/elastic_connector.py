@@ -1,41 +1,55 @@
 import logging
 import os
 import time
-import datetime
 import hashlib
-import json
 
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, helpers
 
-try:
-    from nltk.corpus import stopwords
-except Exception:
-    import nltk
-
-    nltk.download("stopwords")
-    from nltk.corpus import stopwords
-
-    pass
+from metrics_aggregator import MetricsAggregator, MESSAGES_INDEX
+from tagger import Tagger
 
 logger = logging.getLogger(__name__)
 
 ENVIRONMENT_NAME = os.getenv("ENVIRONMENT_NAME", "locahost")
 BOT_VERSION = os.getenv("BOT_VERSION", "notdefined")
-HASH_GEN = hashlib.md5()
+# Write alias of the messages indices, see analytics/setup_elastic.py
+INDEX_NAME = os.getenv("ELASTICSEARCH_INDEX", "messages-write")
+# Documents sent in a single _bulk request
+BULK_SIZE = int(os.getenv("ELASTICSEARCH_BULK_SIZE", 500))
+# Maximum time (in seconds) a document waits in the buffer
+FLUSH_INTERVAL = float(os.getenv("ELASTICSEARCH_FLUSH_INTERVAL", 2))
+BULK_RETRIES = int(os.getenv("ELASTICSEARCH_BULK_RETRIES", 3))
+# Attempts, 5 seconds apart, to find the write alias at startup
+INDEX_ATTEMPTS = int(os.getenv("ELASTICSEARCH_INDEX_ATTEMPTS", 60))
+
+
+def is_transient(status):
+    """Whether a bulk item that failed with status may succeed if sent
+    again. Connection errors have no HTTP status."""
+
+    return not isinstance(status, int) or status == 429 or status >= 500
+
+
+def gen_id(event):
+    """Document id of an event, the same every time the event is indexed so
+    replays overwrite the document instead of duplicating it."""
+
+    key = "{}|{!r}|{}".format(
+        event["sender_id"], event["timestamp"], event["event"])
+    _id = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return "{}_{}_{}".format(ENVIRONMENT_NAME, event["event"], _id)
 
 
-def gen_id(timestamp):
-    HASH_GEN.update(str(timestamp).encode("utf-8"))
-    _id = HASH_GEN.hexdigest()[10:]
-    return _id
+def get_timestamp(event):
+    """Time of the event in epoch milliseconds, as the messages mapping
+    expects. Falls back to the current time for events without one."""
 
+    ts = event.get("timestamp") or time.time()
+    return int(ts * 1000)
 
-def get_timestamp():
-    ts = time.time()
-    timestamp = datetime.datetime.strftime(
-        datetime.datetime.fromtimestamp(ts), "%Y/%m/%d %H:%M:%S"
-    )
-    return timestamp
+
+def get_entities(parse_data):
+    return [entity["entity"] for entity in parse_data.get("entities", [])]
 
 
 class ElasticConnector:
@@ -44,7 +58,10 @@ class ElasticConnector:
                  user=None,
                  password=None,
                  scheme="http",
-                 scheme_port=80
+                 scheme_port=80,
+                 bulk_size=BULK_SIZE,
+                 flush_interval=FLUSH_INTERVAL,
+                 bulk_retries=BULK_RETRIES,
                  ):
         if user is None:
             self.es = Elasticsearch([domain])
@@ -55,71 +72,148 @@ class ElasticConnector:
                  ]
             )
 
-        self.previous_action = None
-        self.previous_user_message = None
+        self.tagger = Tagger()
+        self.metrics = MetricsAggregator(self.es)
+
+        self.bulk_size = bulk_size
+        self.flush_interval = flush_interval
+        self.bulk_retries = bulk_retries
+        self.actions = []
+        self.last_flush = time.monotonic()
+
+    def wait_for_index(self, attempts=INDEX_ATTEMPTS):
+        """Waits for the write alias created by analytics/setup_elastic.py.
+        Indexing without it would auto-create a concrete index with its
+        name, which makes the alias impossible to create afterwards."""
+
+        for _ in range(attempts):
+            try:
+                if self.es.indices.exists_alias(name=INDEX_NAME):
+                    return
+                logger.error("Alias {} does not exist, run "
+                             "analytics/setup_elastic.py".format(INDEX_NAME))
+            except Exception as ex:
+                logger.error("Could not reach Elastic Search: {}".format(ex))
+            time.sleep(5)
+
+        raise RuntimeError("alias {} not found".format(INDEX_NAME))
+
+    def insert_on_elastic(self, event, message):
+        self.actions.append({
+            "_index": INDEX_NAME,
+            "_type": "message",
+            "_id": gen_id(event),
+            "_source": message,
+        })
+
+    def should_flush(self):
+        return (
+            len(self.actions) >= self.bulk_size
+            or time.monotonic() - self.last_flush >= self.flush_interval
+        )
 
-    def insert_on_elastic(self, ts, message):
-        try:
-            self.es.index(
-                index="messages",
-                doc_type="message",
-                id="{}_user_{}".format(ENVIRONMENT_NAME, gen_id(ts)),
-                body=json.dumps(message),
-            )
-        except Exception as ex:
-            logger.error("Could not send message to Elastic Search")
-            logger.error(str(ex))
+    def flush(self):
+        """Sends the buffered documents through the _bulk API, retrying the
+        ones that failed with a transient error. Documents rejected for good,
+        e.g. a mapping error, are logged and dropped, sending them again
+        would fail the same way. Returns whether no document is left to
+        retry.
+
+        The buffer is emptied either way: on failure the messages are
+        expected to be redelivered by the broker."""
+
+        self.last_flush = time.monotonic()
+
+        # Time between the event and its indexing, backlog included
+        indexed_at = int(time.time() * 1000)
+        for action in self.actions:
+            action["_source"]["indexed_at"] = indexed_at
+            action["_source"]["ingest_lag_ms"] = (
+                indexed_at - action["_source"]["timestamp"])
+
+        actions = self.actions
+
+        for attempt in range(self.bulk_retries + 1):
+            if not actions:
+                break
+
+            if attempt > 0:
+                time.sleep(min(2 ** attempt, 30))
+
+            try:
+                _, errors = helpers.bulk(
+                    self.es,
+                    actions,
+                    chunk_size=self.bulk_size,
+                    raise_on_error=False,
+                    raise_on_exception=False,
+                )
+            except Exception as ex:
+                logger.error("Could not send messages to Elastic Search")
+                logger.error(str(ex))
+                continue
+
+            failed = {}
+            for item in errors:
+                for result in item.values():
+                    failed[result["_id"]] = result
+
+            rejected = [a for a in actions if a["_id"] in failed
+                        and not is_transient(failed[a["_id"]].get("status"))]
+            for action in rejected:
+                logger.error("Document {} rejected: {} {}".format(
+                    action["_id"], failed[action["_id"]].get("error"),
+                    action.get("_source", action.get("upsert"))))
+
+            actions = [a for a in actions if a["_id"] in failed
+                       and is_transient(failed[a["_id"]].get("status"))]
+            if actions:
+                logger.error("{} messages were not indexed: {}".format(
+                    len(actions), failed[actions[0]["_id"]]))
+
+        self.actions = []
+        return not actions
+
+    def update_summaries(self, force=False):
+        """Summarizes the minutes of the indexed messages, see
+        MetricsAggregator. Forcing makes the messages visible first."""
+
+        if force:
+            try:
+                self.es.indices.refresh(index=MESSAGES_INDEX)
+            except Exception as ex:
+                logger.error("Could not refresh {}: {}".format(
+                    MESSAGES_INDEX, ex))
+                return False
+
+        return self.metrics.update(force)
 
     def save_user_message(self, user_message):
         if not user_message["text"]:
             return
 
-        ts = time.time()
-        timestamp = datetime.datetime.strftime(
-            datetime.datetime.fromtimestamp(ts), "%Y/%m/%d %H:%M:%S"
-        )
-
         # Bag of words
-        tags = []
-        for word in (
-            user_message["text"]
-            .replace(". ", " ")
-            .replace(",", " ")
-            .replace('"', "")
-            .replace("'", "")
-            .replace("*", "")
-            .replace("(", "")
-            .replace(")", "")
-            .split(" ")
-        ):
-
-            if (word.lower() not in stopwords.words("portuguese")
-                    and len(word) > 1):
-                tags.append(word)
+        tags = self.tagger.tags(user_message["text"])
         confidence = user_message["parse_data"]["intent"]["confidence"]
         message = {
             "environment": ENVIRONMENT_NAME,
             "version": BOT_VERSION,
             "user_id": user_message["sender_id"],
             "is_bot": False,
-            "timestamp": timestamp,
+            "timestamp": get_timestamp(user_message),
             "text": user_message["text"],
             "tags": tags,
-            "entities": user_message["parse_data"]["entities"],
+            "entities": get_entities(user_message["parse_data"]),
             "intent_name": user_message["parse_data"]["intent"]["name"],
             "intent_confidence": confidence,
             "utter_name": "",
             "is_fallback": False,
         }
 
-        self.insert_on_elastic(ts, message)
+        self.insert_on_elastic(user_message, message)
+        self.metrics.add_message(user_message)
 
     def save_bot_message(self, bot_message, action_message, user_message):
-        ts = time.time()
-        timestamp = datetime.datetime.strftime(
-            datetime.datetime.fromtimestamp(ts), "%Y/%m/%d %H:%M:%S"
-        )
-
         message = {
             "environment": ENVIRONMENT_NAME,
             "version": BOT_VERSION,
@@ -127,12 +221,13 @@ class ElasticConnector:
             "is_bot": True,
             "text": user_message["text"],
             "tags": [],
-            "timestamp": timestamp,
+            "timestamp": get_timestamp(bot_message),
             "entities": [],
             "intent_name": user_message["parse_data"]["intent"]["name"],
-            "intent_confidence": "",
+            "intent_confidence": None,
             "utter_name": action_message["name"],
             "is_fallback": action_message["name"] == "action_default_fallback",
         }
 
-        self.insert_on_elastic(ts, message)
+        self.insert_on_elastic(bot_message, message)
+        self.metrics.add_message(bot_message)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""Per minute counts of messages, fallbacks and intent confidence by
+environment, version and intent, kept in the summary index.
+
+The counts are computed from the messages index, never incremented, so a
+redelivered or replayed event is counted once. Run this file to rebuild the
+summaries of the last hours, e.g. after the consumer was stopped before
+updating them."""
+import argparse
+import logging
+import os
+import time
+
+from elasticsearch import helpers
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_INDEX = os.getenv("ELASTICSEARCH_SUMMARY_INDEX", "messages_summary")
+# Read alias of the messages indices, see analytics/setup_elastic.py
+MESSAGES_INDEX = os.getenv("ELASTICSEARCH_READ_INDEX", "messages")
+# Time (in seconds) a minute waits after its last indexed message before
+# being summarized, so the messages are visible to searches
+SUMMARY_DELAY = float(os.getenv("ELASTICSEARCH_SUMMARY_DELAY", 5))
+CONFIDENCE_BUCKETS = 10
+MINUTE_MS = 60 * 1000
+
+
+def get_minute(event):
+    timestamp = event.get("timestamp") or time.time()
+    return int(timestamp // 60) * MINUTE_MS
+
+
+def summary_aggregation(after=None):
+    ranges = [
+        {"key": "confidence_bucket_{}".format(bucket),
+         "from": bucket / CONFIDENCE_BUCKETS,
+         "to": (bucket + 1) / CONFIDENCE_BUCKETS}
+        for bucket in range(CONFIDENCE_BUCKETS)
+    ]
+    # Confidence 1.0 goes to the last bucket, a missing one to the first
+    del ranges[-1]["to"]
+
+    composite = {
+        "size": 1000,
+        "sources": [
+            {"minute": {"date_histogram": {"field": "timestamp",
+                                           "interval": "1m"}}},
+            {"environment": {"terms": {"field": "environment"}}},
+            {"version": {"terms": {"field": "version"}}},
+            {"intent_name": {"terms": {"field": "intent_name"}}},
+        ],
+    }
+    if after is not None:
+        composite["after"] = after
+
+    return {
+        "composite": composite,
+        "aggs": {
+            "user_messages": {
+                "filter": {"term": {"is_bot": False}},
+                "aggs": {"confidence": {"range": {
+                    "field": "intent_confidence",
+                    "missing": 0,
+                    "keyed": True,
+                    "ranges": ranges,
+                }}},
+            },
+            "bot_messages": {
+                "filter": {"term": {"is_bot": True}},
+                "aggs": {"fallbacks": {
+                    "filter": {"term": {"is_fallback": True}}}},
+            },
+        },
+    }
+
+
+def summary_document(bucket):
+    key = bucket["key"]
+    user_messages = bucket["user_messages"]
+    summary = {
+        "minute": key["minute"],
+        "environment": key["environment"],
+        "version": key["version"],
+        "intent_name": key["intent_name"],
+        "user_messages": user_messages["doc_count"],
+        "bot_messages": bucket["bot_messages"]["doc_count"],
+        "fallbacks": bucket["bot_messages"]["fallbacks"]["doc_count"],
+    }
+
+    for name, confidence in user_messages["confidence"]["buckets"].items():
+        if confidence["doc_count"]:
+            summary[name] = confidence["doc_count"]
+    return summary
+
+
+class MetricsAggregator:
+    """Keeps the summary of the minutes with new messages up to date.
+
+    Minutes are marked as the messages are saved and summarized again from
+    the messages index once SUMMARY_DELAY passed since the last mark. Every
+    worker writing to a minute summarizes it after its own writes, the last
+    one sees the messages of all of them."""
+
+    def __init__(self, es, index=SUMMARY_INDEX,
+                 messages_index=MESSAGES_INDEX, delay=SUMMARY_DELAY):
+        self.es = es
+        self.index = index
+        self.messages_index = messages_index
+        self.delay = delay
+        # Minutes to summarize, by the time they were last marked
+        self.minutes = {}
+
+    def add_message(self, event):
+        self.minutes[get_minute(event)] = time.monotonic()
+
+    def summarize(self, first_minute, last_minute):
+        """Writes the summaries of the minutes between first_minute and
+        last_minute, in epoch milliseconds. Returns whether all of them
+        were written."""
+
+        query = {"range": {"timestamp": {
+            "gte": first_minute,
+            "lt": last_minute + MINUTE_MS,
+            "format": "epoch_millis",
+        }}}
+        after = None
+        ok = True
+
+        while True:
+            response = self.es.search(index=self.messages_index, body={
+                "size": 0,
+                "query": query,
+                "aggs": {"summary": summary_aggregation(after)},
+            })
+            result = response["aggregations"]["summary"]
+
+            actions = []
+            for bucket in result["buckets"]:
+                summary = summary_document(bucket)
+                actions.append({
+                    "_op_type": "index",
+                    "_index": self.index,
+                    "_type": "summary",
+                    "_id": "{}_{}_{}_{}".format(
+                        summary["environment"], summary["version"],
+                        summary["intent_name"], summary["minute"]),
+                    "_source": summary,
+                })
+
+            if actions:
+                _, errors = helpers.bulk(
+                    self.es, actions, raise_on_error=False,
+                    raise_on_exception=False)
+                if errors:
+                    logger.error("{} summaries were not written: {}".format(
+                        len(errors), errors[0]))
+                    ok = False
+
+            after = result.get("after_key")
+            if not result["buckets"] or after is None:
+                return ok
+
+    def update(self, force=False):
+        """Summarizes the marked minutes that are ready, all of them when
+        forced. The messages index must be refreshed before forcing."""
+
+        now = time.monotonic()
+        ready = [
+            minute for minute, marked in self.minutes.items()
+            if force or now - marked >= self.delay
+        ]
+        if not ready:
+            return True
+
+        try:
+            ok = self.summarize(min(ready), max(ready))
+        except Exception as ex:
+            logger.error("Could not update the summaries: {}".format(ex))
+            return False
+
+        if ok:
+            for minute in ready:
+                del self.minutes[minute]
+        return ok
+
+
+if __name__ == "__main__":
+    from consume_bot_messages import create_elastic_connector
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="rebuilds the per minute summaries")
+    parser.add_argument("--hours", type=float, default=24,
+                        help="summarizes the minutes of the last hours")
+    args = parser.parse_args()
+
+    aggregator = create_elastic_connector().metrics
+    last_minute = get_minute({})
+    first_minute = last_minute - int(args.hours * 60) * MINUTE_MS
+    if not aggregator.summarize(first_minute, last_minute):
+        raise SystemExit(1)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""Replays bot events into Elasticsearch, e.g. after the consumer was down
+or the index mapping changed.
+
+The input is a JSONL file where each line is either a single event, as
+published on bot_messages, or a tracker export ({"sender_id": ...,
+"events": [...]}). Events are paired like the live consumer does and bulk
+indexed by parallel workers, each one owning a set of senders. Progress is
+saved in a checkpoint file after every chunk, so an interrupted replay
+resumes where it stopped. Document ids are deterministic, replaying the same
+events again overwrites the documents.
+
+The checkpoint is the line of the oldest user event whose conversation turn
+is still open, not ended by action_listen, so a resumed replay pairs the bot
+events of that turn as the full replay does."""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import time
+
+from consume_bot_messages import create_elastic_connector, shard_of
+from conversation_state import ConversationPairer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def read_events(line):
+    record = json.loads(line)
+    if "events" not in record:
+        return [record]
+
+    events = []
+    for event in record["events"]:
+        event.setdefault("sender_id", record["sender_id"])
+        events.append(event)
+    return events
+
+
+def replay_worker(events_queue, results_queue):
+    connector = create_elastic_connector()
+    pairer = ConversationPairer(connector, idle_timeout=float("inf"))
+    indexed = 0
+    ok = True
+
+    while True:
+        item = events_queue.get()
+        if item is None:
+            break
+
+        chunk, events = item
+        try:
+            for event in events:
+                pairer.handle(event)
+                if connector.should_flush():
+                    indexed += len(connector.actions)
+                    ok = connector.flush() and ok
+
+            indexed += len(connector.actions)
+            ok = connector.flush() and ok
+            ok = connector.update_summaries(force=True) and ok
+        except Exception:
+            logger.exception("Could not replay chunk {}".format(chunk))
+            ok = False
+
+        results_queue.put((chunk, indexed, ok))
+        indexed = 0
+
+
+def read_checkpoint(path):
+    if not os.path.isfile(path):
+        return 0
+
+    with open(path) as f:
+        return int(f.read().strip() or 0)
+
+
+def write_checkpoint(path, lines):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(str(lines))
+    os.replace(tmp_path, path)
+
+
+def get_result(results_queue, processes):
+    """Result of a worker, None if a worker died without sending it."""
+
+    while True:
+        try:
+            return results_queue.get(timeout=1)
+        except queue.Empty:
+            if not all(process.is_alive() for process in processes):
+                logger.error("A replay worker stopped unexpectedly")
+                return None
+
+
+def resume_line(open_turns, line_number):
+    """Line after which the replay can resume, the one before the oldest
+    user event of an open turn."""
+
+    if not open_turns:
+        return line_number
+    return min(open_turns.values()) - 1
+
+
+def replay(path, workers, chunk_size, checkpoint_path):
+    start_line = read_checkpoint(checkpoint_path)
+    if start_line:
+        logger.info("Resuming from line {}".format(start_line))
+
+    events_queues = [multiprocessing.Queue(maxsize=2) for _ in range(workers)]
+    results_queue = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=replay_worker, args=(events_queue, results_queue))
+        for events_queue in events_queues
+    ]
+    for process in processes:
+        process.start()
+
+    started = time.monotonic()
+    total_events = 0
+    total_docs = 0
+    line_number = 0
+    chunk = 0
+    failed = False
+
+    def dispatch(shards, lines):
+        nonlocal total_docs, failed
+
+        for shard, events_queue in enumerate(events_queues):
+            events_queue.put((chunk, shards[shard]))
+
+        for _ in range(workers):
+            result = get_result(results_queue, processes)
+            if result is None:
+                failed = True
+                return False
+
+            _, docs, ok = result
+            total_docs += docs
+            failed = failed or not ok
+
+        if failed:
+            return False
+
+        write_checkpoint(checkpoint_path, resume_line(open_turns, lines))
+        elapsed = time.monotonic() - started
+        logger.info(
+            "{} lines, {} events, {} documents, {:.0f} events/s, "
+            "{:.0f} documents/s".format(
+                lines, total_events, total_docs,
+                total_events / elapsed, total_docs / elapsed)
+        )
+        return True
+
+    # Line of the last user event of each sender whose turn is not over
+    open_turns = {}
+
+    with open(path) as f:
+        shards = [[] for _ in range(workers)]
+        pending = 0
+
+        for line_number, line in enumerate(f, 1):
+            if line_number <= start_line or not line.strip():
+                continue
+
+            for event in read_events(line):
+                sender_id = event.get("sender_id")
+                if event.get("event") == "user":
+                    open_turns[sender_id] = line_number
+                elif event.get("name") == "action_listen":
+                    open_turns.pop(sender_id, None)
+
+                shard = shard_of(sender_id, workers)
+                shards[shard].append(event)
+                pending += 1
+
+            if pending >= chunk_size:
+                total_events += pending
+                if not dispatch(shards, line_number):
+                    break
+                shards = [[] for _ in range(workers)]
+                pending = 0
+                chunk += 1
+
+        if pending and not failed:
+            total_events += pending
+            dispatch(shards, line_number)
+
+    for events_queue in events_queues:
+        events_queue.put(None)
+    for process in processes:
+        process.join(timeout=60)
+        if process.is_alive():
+            process.terminate()
+
+    if failed:
+        logger.error("Some documents were not indexed, stopped at the "
+                     "last checkpoint ({})".format(
+                         read_checkpoint(checkpoint_path)))
+        return False
+
+    logger.info("Replay finished in {:.1f}s".format(
+        time.monotonic() - started))
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="replays bot events into Elasticsearch")
+    parser.add_argument("path", help="JSONL file with events or trackers")
+    parser.add_argument("--workers", "-w", type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=10000,
+                        help="events indexed between checkpoints")
+    parser.add_argument("--checkpoint", default=None,
+                        help="defaults to <path>.checkpoint")
+    parser.add_argument("--restart", action="store_true",
+                        help="ignores the checkpoint and starts over")
+    args = parser.parse_args()
+
+    checkpoint = args.checkpoint or args.path + ".checkpoint"
+    if args.restart and os.path.isfile(checkpoint):
+        os.remove(checkpoint)
+
+    if not replay(args.path, args.workers, args.chunk_size, checkpoint):
+        raise SystemExit(1)
@@ -0,0 +1,51 @@
+"""Stopwords left out of the message tags.
+
+The Portuguese list is the one of the NLTK corpus, bundled here so the
+consumer starts without downloading anything. Set TAGS_STOPWORDS_SOURCE to
+"nltk" to read the lists of an installed NLTK corpus instead, e.g. for
+other languages."""
+import os
+
+TAGS_STOPWORDS_SOURCE = os.getenv("TAGS_STOPWORDS_SOURCE", "builtin")
+
+PORTUGUESE = frozenset("""
+de a o que e do da em um para com não uma os no se na por mais as dos como
+mas ao ele das à seu sua ou quando muito nos já eu também só pelo pela até
+isso ela entre depois sem mesmo aos seus quem nas me esse eles você essa
+num nem suas meu às minha numa pelos elas qual nós lhe deles essas esses
+pelas este dele tu te vocês vos lhes meus minhas teu tua teus tuas nosso
+nossa nossos nossas dela delas esta estes estas aquele aquela aqueles
+aquelas isto aquilo estou está estamos estão estive esteve estivemos
+estiveram estava estávamos estavam estivera estivéramos esteja estejamos
+estejam estivesse estivéssemos estivessem estiver estivermos estiverem hei
+há havemos hão houve houvemos houveram houvera houvéramos haja hajamos
+hajam houvesse houvéssemos houvessem houver houvermos houverem houverei
+houverá houveremos houverão houveria houveríamos houveriam sou somos são
+era éramos eram fui foi fomos foram fora fôramos seja sejamos sejam fosse
+fôssemos fossem for formos forem serei será seremos serão seria seríamos
+seriam tenho tem temos tém tinha tínhamos tinham tive teve tivemos tiveram
+tivera tivéramos tenha tenhamos tenham tivesse tivéssemos tivessem tiver
+tivermos tiverem terei terá teremos terão teria teríamos teriam
+""".split())
+
+BUILTIN = {
+    "portuguese": PORTUGUESE,
+}
+
+
+def nltk_words(language):
+    # Imported only when asked for, the corpus must be already downloaded
+    from nltk.corpus import stopwords
+
+    return stopwords.words(language)
+
+
+def load(language="portuguese", source=TAGS_STOPWORDS_SOURCE):
+    if source == "nltk":
+        return nltk_words(language)
+
+    if language not in BUILTIN:
+        raise ValueError(
+            "No built-in stopwords for {}, set TAGS_STOPWORDS_SOURCE=nltk "
+            "to use the NLTK corpus".format(language))
+    return BUILTIN[language]
@@ -0,0 +1,84 @@
+import os
+import re
+import unicodedata
+
+import stopwords
+
+TAGS_STRIP_ACCENTS = os.getenv("TAGS_STRIP_ACCENTS", "False").lower() == "true"
+TAGS_STEM = os.getenv("TAGS_STEM", "False").lower() == "true"
+
+# Commas split words, quotes, asterisks and parentheses are dropped
+PUNCTUATION = str.maketrans({
+    ",": " ",
+    '"': None,
+    "'": None,
+    "*": None,
+    "(": None,
+    ")": None,
+})
+# Words are separated by spaces, a dot followed by spaces ends a word too
+SEPARATOR = re.compile(r"\.?\s+")
+
+
+def remove_accents(text):
+    normalized = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in normalized if not unicodedata.combining(c))
+
+
+class Tagger:
+    """Extracts the bag of words (tags) of a user message, leaving out
+    stopwords and single characters."""
+
+    def __init__(self, language="portuguese", words=None,
+                 strip_accents=TAGS_STRIP_ACCENTS, stem=TAGS_STEM):
+        if words is None:
+            words = stopwords.load(language)
+
+        self.strip_accents = strip_accents
+        self.stopwords = frozenset(self.normalize(w) for w in words)
+
+        self.stemmer = None
+        if stem:
+            from nltk.stem import RSLPStemmer
+
+            try:
+                self.stemmer = RSLPStemmer()
+            except LookupError:
+                raise RuntimeError(
+                    "TAGS_STEM needs the NLTK rslp data, install it with "
+                    "`python -m nltk.downloader rslp`")
+
+    def normalize(self, word):
+        word = word.lower()
+        if self.strip_accents:
+            word = remove_accents(word)
+        return word
+
+    def stem(self, word):
+        """Stems word keeping its case, the stemmer only handles lowercase
+        words."""
+
+        stem = self.stemmer.stem(word.lower())
+        if word.isupper():
+            return stem.upper()
+        if word[0].isupper():
+            return stem.capitalize()
+        return stem
+
+    def tokenize(self, text):
+        return SEPARATOR.split(text.translate(PUNCTUATION))
+
+    def tags(self, text):
+        tags = []
+        for word in self.tokenize(text):
+            if len(word) <= 1 or self.normalize(word) in self.stopwords:
+                continue
+
+            if self.strip_accents:
+                word = remove_accents(word)
+            if self.stemmer is not None:
+                word = self.stem(word)
+
+            tags.append(word)
+
+        return tags
@@ -179,6 +179,10 @@ def configure_webhooks():
             "urls": [rasa_url],
             "username": bot["username"],
             "channel": "@" + bot["username"],
+            # The bot answers 503 when its webhook queue is full
+            "retryFailedCalls": True,
+            "retryCount": 5,
+            "retryDelay": "powers-of-two",
         },
     )
 
@@ -1,15 +1,29 @@
 import requests
 import os
-import wget
 import hashlib
+import json
+import shutil
+import tarfile
 import time
 
+from urllib3.exceptions import HTTPError
 
+
+# Symlink to the folder of the current models version
 MODEL_FOLDER = "/models"
 MODEL_FILENAME = "models.tar.gz"
+# Kept inside each models version folder
+MANIFEST_FILENAME = ".manifest.json"
 MODEL_HOST = os.getenv("COACH_URL", "coach")
 VERSION_URL = "http://" + MODEL_HOST + "/version"
 FILE_URL = "http://" + MODEL_HOST + "/" + MODEL_FILENAME
+MANIFEST_URL = "http://" + MODEL_HOST + "/manifest.json"
+FILES_URL = "http://" + MODEL_HOST + "/files/"
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = 30
+# Times a dropped download is resumed from its last byte
+RETRIES = int(os.getenv("MODEL_DOWNLOAD_RETRIES", 5))
+REPORT_INTERVAL = 5
 
 
 def try_connect_coach():
@@ -32,37 +46,242 @@ def get_version():
         return False
 
 
-def md5(fname):
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest() + "  " + fname + "\n"
+def get_manifest():
+    """Manifest of the models served by the coach, None for coaches that
+    only serve the whole tarball."""
+
+    r = requests.get(url=MANIFEST_URL, timeout=TIMEOUT)
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    return r.json()
+
+
+def read_local_manifest():
+    path = os.path.join(MODEL_FOLDER, MANIFEST_FILENAME)
+    if not os.path.isfile(path):
+        return {"version": None, "files": {}}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(folder, manifest):
+    with open(os.path.join(folder, MANIFEST_FILENAME), "w") as f:
+        json.dump(manifest, f)
+
+
+def create_staging_folder(version):
+    folder = "{}.{}".format(MODEL_FOLDER, version[:16])
+    if os.path.realpath(MODEL_FOLDER) == folder:
+        raise RuntimeError("version {} is already in use".format(version))
+
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    return folder
+
+
+class Download:
+    """Read only file object over the body of url, hashed as it is read.
+
+    When the connection drops the request is sent again with a Range header
+    starting at the last byte read, so the reader, e.g. tarfile, does not
+    notice the interruption."""
+
+    def __init__(self, url, hash_name="sha256"):
+        self.url = url
+        self.hash = hashlib.new(hash_name)
+        self.response = None
+        self.offset = 0
+        self.size = None
+        self.started = time.monotonic()
+        self.last_report = self.started
+
+    def open(self):
+        headers = {}
+        if self.offset:
+            headers["Range"] = "bytes={}-".format(self.offset)
+
+        r = requests.get(url=self.url, headers=headers, stream=True,
+                         timeout=TIMEOUT)
+        r.raise_for_status()
+        if self.offset and r.status_code != 206:
+            r.close()
+            raise RuntimeError("{} can not be resumed".format(self.url))
+
+        if self.size is None and "Content-Length" in r.headers:
+            self.size = int(r.headers["Content-Length"])
+        self.response = r
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+
+    def read(self, size=-1):
+        for attempt in range(RETRIES + 1):
+            try:
+                if self.response is None:
+                    self.open()
+                data = self.response.raw.read(size if size >= 0 else None)
+                if not data and self.size is not None \
+                        and self.offset < self.size:
+                    raise HTTPError("connection closed at byte {}".format(
+                        self.offset))
+                break
+            except (HTTPError, requests.RequestException, OSError) as e:
+                self.close()
+                if attempt == RETRIES:
+                    raise
+                print("{}, resuming {} from byte {}".format(
+                    e, self.url, self.offset))
+                time.sleep(2 ** attempt)
+
+        if data:
+            self.offset += len(data)
+            self.hash.update(data)
+            self.report()
+        elif self.last_report is not None:
+            self.report(done=True)
+            self.last_report = None
+        return data
+
+    def chunks(self):
+        for chunk in iter(lambda: self.read(CHUNK_SIZE), b""):
+            yield chunk
+
+    def hexdigest(self):
+        # Bytes the reader left unread, e.g. the end of a tarball
+        for _ in self.chunks():
+            pass
+        self.close()
+        return self.hash.hexdigest()
+
+    def report(self, done=False):
+        now = time.monotonic()
+        if self.last_report is None:
+            return
+        if not done and now - self.last_report < REPORT_INTERVAL:
+            return
+
+        self.last_report = now
+        print("{}: {} of {} bytes, {:.0f} bytes/s".format(
+            self.url, self.offset, self.size or "?",
+            self.offset / max(now - self.started, 1e-6)))
 
 
-def uncompress_models(filename):
-    os.system("tar -xzvf " + filename)
-    os.system("mv src_models " + MODEL_FOLDER)
+def download_file(file_hash, path):
+    download = Download(FILES_URL + file_hash)
+    with open(path, "wb") as f:
+        for chunk in download.chunks():
+            f.write(chunk)
+
+    if download.hexdigest() != file_hash:
+        raise RuntimeError("corrupted download of " + path)
+
+
+def reuse_file(source, path):
+    try:
+        os.link(source, path)
+    except OSError:
+        shutil.copy2(source, path)
+
+
+def stage_delta(manifest, local_manifest):
+    """Builds the new models version reusing the current files whose hash
+    did not change, only the other ones are downloaded."""
+
+    folder = create_staging_folder(manifest["version"])
+    current_files = {
+        entry["sha256"]: os.path.join(MODEL_FOLDER, path)
+        for path, entry in local_manifest["files"].items()
+    }
+    downloaded = 0
+
+    for path, entry in manifest["files"].items():
+        target = os.path.join(folder, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        source = current_files.get(entry["sha256"])
+        if source is not None and os.path.isfile(source):
+            reuse_file(source, target)
+        else:
+            print("downloading " + path)
+            download_file(entry["sha256"], target)
+            downloaded += entry["size"]
+
+    print("{} bytes downloaded, {} files".format(
+        downloaded, len(manifest["files"])))
+    write_manifest(folder, manifest)
+    return folder
+
+
+def stage_tarball(version):
+    """Extracts the whole tarball while it is downloaded, without saving
+    it to disk. The version is the md5sum line of the tarball, checked once
+    it is fully read."""
+
+    folder = create_staging_folder(hashlib.sha256(version.encode())
+                                   .hexdigest())
+    download = Download(FILE_URL, hash_name="md5")
+    with tarfile.open(fileobj=download, mode="r|gz") as tar:
+        for member in tar:
+            # Members are src_models/..., extracted without the prefix
+            parts = member.name.split("/")[1:]
+            if not parts or ".." in parts or member.issym() \
+                    or member.islnk():
+                continue
+            member.name = os.path.join(*parts)
+            tar.extract(member, folder)
+
+    if download.hexdigest() != version.split()[0]:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise RuntimeError("corrupted download of " + FILE_URL)
+
+    write_manifest(folder, {"version": version, "files": {}})
+    return folder
+
+
+def swap_models(folder):
+    """Points MODEL_FOLDER to the new version at once, the bot never sees
+    a partially updated models folder."""
+
+    previous = None
+    if os.path.islink(MODEL_FOLDER):
+        previous = os.path.realpath(MODEL_FOLDER)
+    elif os.path.isdir(MODEL_FOLDER):
+        # Folder of the versions before the manifest, moved aside once
+        previous = MODEL_FOLDER + ".old"
+        shutil.rmtree(previous, ignore_errors=True)
+        os.rename(MODEL_FOLDER, previous)
+
+    link = MODEL_FOLDER + ".link"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(folder, link)
+    os.replace(link, MODEL_FOLDER)
+
+    if previous is not None:
+        shutil.rmtree(previous, ignore_errors=True)
 
 
 if __name__ == "__main__":
 
     try_connect_coach()
 
-    if os.path.isfile(MODEL_FILENAME):
-        print("file already exist")
-        r = requests.get(url=VERSION_URL)
-        file_hash = md5(MODEL_FILENAME)
-        if r.text != file_hash:
-            print("new version model file")
-            os.system("rm -r " + MODEL_FILENAME)
-            os.system("rm -rf " + MODEL_FOLDER)
-            wget.download(FILE_URL)
-            uncompress_models(MODEL_FILENAME)
-        else:
-            print("same model")
-            uncompress_models(MODEL_FILENAME)
+    manifest = get_manifest()
+    local_manifest = read_local_manifest()
+
+    if manifest is not None:
+        version = manifest["version"]
+    else:
+        version = requests.get(url=VERSION_URL).text
+
+    if local_manifest["version"] == version:
+        print("same model")
+    elif manifest is not None:
+        print("new version model files")
+        swap_models(stage_delta(manifest, local_manifest))
     else:
-        print("model not found")
-        wget.download(FILE_URL)
-        uncompress_models(MODEL_FILENAME)
+        print("new version model file")
+        swap_models(stage_tarball(version))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Builds the manifest of the trained models served by the coach.
+
+Every file of the models folder is copied to the objects folder, named
+after the sha256 of its content, and listed in the manifest with its hash
+and size. The bots compare the manifest with the one of their current
+models and download only the files whose hash changed, see
+model_downloader.py."""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+
+CHUNK_SIZE = 64 * 1024
+
+
+def sha256(path):
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def manifest_version(files):
+    version = hashlib.sha256()
+    for path in sorted(files):
+        version.update("{} {}\n".format(path, files[path]["sha256"]).encode())
+    return version.hexdigest()
+
+
+def build_manifest(models_folder, objects_folder):
+    os.makedirs(objects_folder, exist_ok=True)
+    files = {}
+
+    for root, _, filenames in os.walk(models_folder):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            relative_path = os.path.relpath(path, models_folder)
+            file_hash = sha256(path)
+
+            files[relative_path] = {
+                "sha256": file_hash,
+                "size": os.path.getsize(path),
+            }
+            shutil.copyfile(path, os.path.join(objects_folder, file_hash))
+
+    return {"version": manifest_version(files), "files": files}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="builds the models manifest")
+    parser.add_argument("models_folder")
+    parser.add_argument("--objects", "-o", default="/model_files",
+                        help="folder of the files named by their hash")
+    parser.add_argument("--manifest", "-m", default="/model_manifest.json")
+    args = parser.parse_args()
+
+    manifest = build_manifest(args.models_folder, args.objects)
+    with open(args.manifest, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    print("{} files, version {}".format(
+        len(manifest["files"]), manifest["version"]))
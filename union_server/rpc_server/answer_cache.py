@@ -0,0 +1,68 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+SPACES = re.compile(r"\s+")
+
+
+def normalize(text):
+    return SPACES.sub(" ", text).strip(" .!?").lower()
+
+
+class AnswerCache:
+    """Bounded LRU cache of union answers, keyed by the normalized user
+    message and the bot asking. Entries expire after `ttl` seconds."""
+
+    def __init__(self, max_size=1000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "invalidations": 0,
+        }
+
+    def get(self, text, bot_name):
+        key = (normalize(text), bot_name)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.stats["misses"] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def set(self, text, bot_name, answer):
+        if self.max_size <= 0:
+            return
+
+        key = (normalize(text), bot_name)
+
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, answer)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.stats["invalidations"] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self.entries)
+
+        return stats
@@ -1,11 +1,147 @@
+import os
+import threading
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+# Keep-alive connections kept for each bot host
+POOL_SIZE = int(os.getenv("UNION_HTTP_POOL_SIZE", 10))
+# Number of bot hosts with a pool kept open
+POOL_HOSTS = int(os.getenv("UNION_HTTP_POOL_HOSTS", 10))
+CONNECT_TIMEOUT = float(os.getenv("UNION_HTTP_CONNECT_TIMEOUT", 1))
+READ_TIMEOUT = float(os.getenv("UNION_HTTP_READ_TIMEOUT", 5))
+RETRIES = int(os.getenv("UNION_HTTP_RETRIES", 2))
+BACKOFF_FACTOR = float(os.getenv("UNION_HTTP_BACKOFF_FACTOR", 0.1))
+
+_stats_lock = threading.Lock()
+_stats = {
+    "requests": 0,
+    "new_connections": 0,
+    "pool_exhausted": 0,
+}
+
+_session_lock = threading.Lock()
+_session = None
+
+
+def _increment(counter):
+    with _stats_lock:
+        _stats[counter] += 1
+
+
+def get_stats():
+    """Returns a snapshot of the connection pool counters."""
+
+    with _stats_lock:
+        stats = dict(_stats)
+
+    stats["reused_connections"] = max(
+        stats["requests"] - stats["new_connections"], 0)
+
+    return stats
+
+
+class CountingPoolMixin:
+    def _get_conn(self, timeout=None):
+        _increment("requests")
+        if self.pool is not None and self.pool.empty():
+            # Every connection of this host is in use, urllib3 will open
+            # a new one and discard it afterwards.
+            _increment("pool_exhausted")
+
+        return super()._get_conn(timeout=timeout)
+
+
+class CountingConnectionMixin:
+    def connect(self):
+        # Called for every TCP connection, including the ones urllib3
+        # opens again on a pooled connection whose socket was closed
+        _increment("new_connections")
+        return super().connect()
+
+
+class CountingHTTPConnection(CountingConnectionMixin,
+                             HTTPConnectionPool.ConnectionCls):
+    pass
+
+
+class CountingHTTPSConnection(CountingConnectionMixin,
+                              HTTPSConnectionPool.ConnectionCls):
+    pass
+
+
+class CountingHTTPConnectionPool(CountingPoolMixin, HTTPConnectionPool):
+    ConnectionCls = CountingHTTPConnection
+
+
+class CountingHTTPSConnectionPool(CountingPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = CountingHTTPSConnection
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+
+def create_session():
+    # Read errors and error statuses are only retried on idempotent
+    # methods, so a POST to /respond is never processed twice by a bot.
+    retries = Retry(
+        total=RETRIES,
+        connect=RETRIES,
+        read=RETRIES,
+        status=RETRIES,
+        status_forcelist=(502, 503, 504),
+        backoff_factor=BACKOFF_FACTOR,
+    )
+    adapter = PooledHTTPAdapter(
+        pool_connections=POOL_HOSTS,
+        pool_maxsize=POOL_SIZE,
+        max_retries=retries,
+    )
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"content-type": "application/json"})
+
+    return session
+
+
+def get_session():
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+
+    return _session
+
+
+def get_timeout(timeout=None):
+    if timeout is None:
+        return (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+    return (min(CONNECT_TIMEOUT, timeout), min(READ_TIMEOUT, timeout))
+
+
+def get_request(payload, url, timeout=None):
+    return get_session().get(
+        url, data=payload, timeout=get_timeout(timeout)).json()
 
 
-def get_request(payload, url):
-    header = {"content-type": "application/json"}
-    return requests.get(url, data=payload, headers=header).json()
+def post_request(payload, url, timeout=None):
+    return get_session().post(
+        url, data=payload, timeout=get_timeout(timeout)).json()
 
 
-def post_request(payload, url):
-    header = {"content-type": "application/json"}
-    return requests.post(url, data=payload, headers=header).json()
+def put_request(payload, url, timeout=None):
+    return get_session().put(
+        url, data=payload, timeout=get_timeout(timeout)).json()
@@ -4,12 +4,41 @@ import yaml
 import os
 import json
 import time
-from api_helper import get_request, post_request
+import functools
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from answer_cache import AnswerCache
+from api_helper import get_request, post_request, put_request, get_stats
+from sender_pool import SenderPool
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+# "concurrent" asks every bot at the same time, "sequential" asks one by one
+FANOUT_MODE = os.getenv("UNION_FANOUT_MODE", "concurrent")
+# Threads asking the bots, 0 gives every message in flight a thread for
+# each bot, so no ask waits for a thread while its deadline runs
+FANOUT_WORKERS = int(os.getenv("UNION_FANOUT_WORKERS", 0))
+# Overall time (in seconds) the union waits for the bots to answer. Keep it
+# below the rpc_timeout of BottisPolicy (policy_config.yml), which also
+# covers the broker round trip.
+ASK_TIMEOUT = float(os.getenv("UNION_ASK_TIMEOUT", 5))
+# "request" talks to the bots with a conversation of its own for every
+# message, reset after reading the answer and reused by later messages.
+# "default" reuses the shared default conversation
+ANSWER_SENDER = os.getenv("UNION_ANSWER_SENDER", "request")
+# Number of server processes consuming the rpc_queue
+WORKERS = int(os.getenv("UNION_WORKERS", 1))
+# Number of user messages each process handles at the same time
+PREFETCH = int(os.getenv("UNION_PREFETCH", 1))
+# Answers cached by message and asking bot, 0 disables the cache
+CACHE_SIZE = int(os.getenv("UNION_CACHE_SIZE", 1000))
+CACHE_TTL = float(os.getenv("UNION_CACHE_TTL", 300))
+# Interval (in seconds) between checks for new bot models
+CACHE_VERSION_INTERVAL = float(os.getenv("UNION_CACHE_VERSION_INTERVAL", 30))
+
 
 class RPCServer:
     def __init__(self):
@@ -19,14 +48,21 @@ class RPCServer:
 
         broker_url = os.getenv("BROKER_URL", "")
 
-        connection = pika.BlockingConnection(
+        self.connection = pika.BlockingConnection(
             pika.ConnectionParameters(host=broker_url, credentials=credentials)
         )
 
-        self.channel = connection.channel()
+        self.channel = self.connection.channel()
         self.channel.queue_declare(queue="rpc_queue")
 
-        self.bot_name = ""
+        self.prefetch = PREFETCH
+        self.request_executor = ThreadPoolExecutor(max_workers=PREFETCH)
+        self.fanout_mode = FANOUT_MODE
+        self.ask_timeout = ASK_TIMEOUT
+        self.answer_sender = ANSWER_SENDER
+        self.cache = AnswerCache(max_size=CACHE_SIZE, ttl=CACHE_TTL)
+        self.bots_versions = {}
+
         self.config = {}
         with open("union_config.yml", "r") as stream:
             try:
@@ -34,7 +70,14 @@ class RPCServer:
             except yaml.YAMLError as exc:
                 logger.error(exc)
 
-    def get_best_answer(self, answers):
+        fanout_workers = FANOUT_WORKERS or PREFETCH * max(
+            len(self.get_bots_urls()), 1)
+        self.executor = ThreadPoolExecutor(max_workers=fanout_workers)
+        # Resets run after the answer is read, outside of the ask deadline
+        self.reset_executor = ThreadPoolExecutor(max_workers=fanout_workers)
+        self.senders = SenderPool()
+
+    def get_best_answer(self, answers, bot_name):
         # TODO: Fazer a hierarquia das policies, antes da confiança
         # fallback_threshold = self.fallback_threshold
         fallback_threshold = 0.5
@@ -54,13 +97,13 @@ class RPCServer:
             best_answer = self.find_answer_by_confidence(
                 answers, max_confidence)
         else:
-            best_answer = self.main_bot_fallback()
+            best_answer = self.main_bot_fallback(bot_name)
 
         return best_answer
 
-    def main_bot_fallback(self):
+    def main_bot_fallback(self, bot_name):
         return {
-            "bot": self.bot_name,
+            "bot": bot_name,
             "total_confidence": 2,
             "intent_confidence": 1,
             "utter_confidence": 1,
@@ -73,43 +116,108 @@ class RPCServer:
             ],
         }
 
+    def get_bots_urls(self):
+        return [v.get("url")[0] for v in self.config.values()]
+
     def get_ask_list(self, bot_name):
         bots_urls = []
         ask_to = self.config[bot_name]["ask_to"]
 
         if "all" in ask_to:
-            bots_urls = [v.get("url")[0] for v in self.config.values()]
+            bots_urls = self.get_bots_urls()
         else:
             pass
 
         return bots_urls
 
-    def get_answer_info(self, message, bot_url):
-        payload = {"query": message}
-        payload = json.dumps(payload)
+    def check_bots_versions(self):
+        """Clears the answer cache when a bot loads a new model."""
 
-        r = get_request(payload, "http://" + bot_url +
-                        "/conversations/default/tracker")
+        for bot in self.get_bots_urls():
+            try:
+                r = get_request(None, "http://" + bot + "/status")
+                version = r["model_fingerprint"]
+            except Exception:
+                # Unreachable bots keep their last known version
+                continue
 
-        answer_info = {}
+            last_version = self.bots_versions.get(bot)
+            self.bots_versions[bot] = version
+
+            if last_version is not None and last_version != version:
+                logger.warning("New model on bot {}, clearing cache".format(
+                    bot))
+                self.cache.clear()
+
+    def watch_bots_versions(self):
+        while True:
+            self.check_bots_versions()
+            time.sleep(CACHE_VERSION_INTERVAL)
+
+    def new_sender_id(self):
+        if self.answer_sender == "default":
+            return "default"
+
+        return self.senders.acquire()
 
-        iterator = iter(r["events"])
-        for event in iterator:
-            if "event" in event and "user" == event["event"]:
-                if message == event["text"]:
-                    confidence = event["parse_data"]["intent"]["confidence"]
-                    intent_name = event["parse_data"]["intent"]["name"]
+    def release_sender_id(self, bot_url, sender_id):
+        """Empties the conversation of sender_id so it can be reused,
+        otherwise the bot would keep every conversation the union had."""
 
-                    answer_info["intent_confidence"] = confidence
-                    answer_info["intent_name"] = intent_name
+        if sender_id == "default":
+            return
 
-                    # always after a user event,
-                    # there is a action event with policy info.
-                    answer_info["utter_confidence"], answer_info[
-                        "policy_name"
-                    ] = self.get_policy_info(iterator)
+        try:
+            put_request(
+                json.dumps([]),
+                "http://{}/conversations/{}/tracker/events".format(
+                    bot_url, sender_id),
+            )
+        except Exception as exc:
+            logger.warning("Could not reset conversation {} on {}: {}".format(
+                sender_id, bot_url, exc))
+            return
+
+        self.senders.release(sender_id)
+
+    def find_user_event(self, events, message):
+        """Returns the position of the latest user event with the message,
+        or None if the bot did not register it."""
+
+        for idx in range(len(events) - 1, -1, -1):
+            event = events[idx]
+            if event.get("event") == "user" and event.get("text") == message:
+                return idx
+
+        return None
+
+    def get_answer_info(self, message, bot_url, sender_id="default",
+                        timeout=None):
+        r = get_request(
+            None,
+            "http://{}/conversations/{}/tracker?include_events={}".format(
+                bot_url, sender_id, "AFTER_RESTART"
+            ),
+            timeout=timeout,
+        )
+
+        answer_info = {}
+
+        events = r["events"]
+        idx = self.find_user_event(events, message)
+        if idx is not None:
+            event = events[idx]
+            confidence = event["parse_data"]["intent"]["confidence"]
+            intent_name = event["parse_data"]["intent"]["name"]
 
-                    break
+            answer_info["intent_confidence"] = confidence
+            answer_info["intent_name"] = intent_name
+
+            # always after a user event,
+            # there is a action event with policy info.
+            answer_info["utter_confidence"], answer_info[
+                "policy_name"
+            ] = self.get_policy_info(iter(events[idx + 1:]))
 
         if answer_info == {}:
             answer_info["intent_confidence"] = -1
@@ -120,12 +228,14 @@ class RPCServer:
 
         return answer_info
 
-    def send_message(self, text, bot_url):
+    def send_message(self, text, bot_url, sender_id="default", timeout=None):
         payload = {"query": text}
         payload = json.dumps(payload)
 
         r = post_request(
-            payload, "http://" + bot_url + "/conversations/default/respond"
+            payload,
+            "http://{}/conversations/{}/respond".format(bot_url, sender_id),
+            timeout=timeout,
         )
 
         messages = []
@@ -135,46 +245,124 @@ class RPCServer:
 
         return messages
 
+    def remaining_time(self, deadline):
+        if deadline is None:
+            return None
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Deadline expired before asking the bot")
+
+        return remaining
+
+    def ask_bot(self, text, bot, deadline=None):
+        """Asks a single bot, returns its answer or None if there is no
+        valid answer before the deadline."""
+
+        # An empty conversation only holds the events of this message, so
+        # reading its tracker costs the same no matter how old the bot is.
+        sender_id = self.new_sender_id()
+
+        try:
+            messages = self.send_message(
+                text, bot, sender_id, timeout=self.remaining_time(deadline))
+            info = self.get_answer_info(
+                text, bot, sender_id, timeout=self.remaining_time(deadline))
+            # Only reused once the bot is done with it. After a timeout the
+            # bot may still be answering, the id is dropped instead.
+            self.reset_executor.submit(self.release_sender_id, bot, sender_id)
+
+            if "fallback" in info["policy_name"].lower():
+                return None
+
+            return {
+                "bot": bot,
+                "messages": messages,
+                "intent_name": info["intent_name"],
+                "intent_confidence": info["intent_confidence"],
+                "utter_confidence": info["utter_confidence"],
+                "total_confidence": info["intent_confidence"]
+                + info["utter_confidence"],
+                "policy_name": info["policy_name"],
+            }
+        except Exception as exc:
+            logger.warn("Bot didn't answer: " + bot)
+            logger.warn("Connection Error: ")
+            logger.warn(exc)
+
+        return None
+
+    def ask_bots_concurrently(self, text, bots_urls, deadline):
+        futures = {
+            self.executor.submit(self.ask_bot, text, bot, deadline): bot
+            for bot in bots_urls
+        }
+
+        done, not_done = wait(
+            futures, timeout=max(deadline - time.monotonic(), 0))
+
+        # Stragglers are dropped. The ones already running are bounded by
+        # the request timeout and their answers are ignored.
+        for future in not_done:
+            future.cancel()
+            logger.warning("Bot didn't answer in time: " + futures[future])
+
+        return [future.result() for future in done]
+
     def ask_bots(self, text, bot_name):
-        answers = []
+        answer = self.cache.get(text, bot_name)
+        if answer is not None:
+            return answer
+
         bots_urls = self.get_ask_list(bot_name)
+        deadline = time.monotonic() + self.ask_timeout
 
-        for bot in bots_urls:
-            try:
-                messages = self.send_message(text, bot)
-                info = self.get_answer_info(text, bot)
-
-                if "fallback" in info["policy_name"].lower():
-                    continue
-
-                bot_answer = {
-                    "bot": bot,
-                    "messages": messages,
-                    "intent_name": info["intent_name"],
-                    "intent_confidence": info["intent_confidence"],
-                    "utter_confidence": info["utter_confidence"],
-                    "total_confidence": info["intent_confidence"]
-                    + info["utter_confidence"],
-                    "policy_name": info["policy_name"],
-                }
-                answers.append(bot_answer)
-            except Exception as exc:
-                logger.warn("Bot didn't answer: " + bot)
-                logger.warn("Connection Error: ")
-                logger.warn(exc)
-
-        answer = self.get_best_answer(answers)
+        if self.fanout_mode == "concurrent":
+            answers = self.ask_bots_concurrently(text, bots_urls, deadline)
+        else:
+            answers = [self.ask_bot(text, bot, deadline) for bot in bots_urls]
+
+        answers = [answer for answer in answers if answer is not None]
+        answer = self.get_best_answer(answers, bot_name)
+
+        # Fallbacks may come from bots being down, they are not cached
+        if answer.get("policy_name") not in (None, "Fallback"):
+            self.cache.set(text, bot_name, answer)
 
         return answer
 
     def on_request(self, ch, method, props, body):
-        bot_message = json.loads(body.decode("utf-8"))["bot_message"]
-        self.bot_name = json.loads(body.decode("utf-8"))["bot_name"]
+        # Runs on the connection thread, the bots are asked by the request
+        # executor so up to `prefetch` messages are handled at once.
+        request = json.loads(body.decode("utf-8"))
+
+        self.request_executor.submit(
+            self.handle_request,
+            ch,
+            method.delivery_tag,
+            props,
+            request["bot_message"],
+            request["bot_name"],
+        )
 
-        answer = self.ask_bots(bot_message, self.bot_name)
+    def handle_request(self, ch, delivery_tag, props, bot_message, bot_name):
+        try:
+            answer = self.ask_bots(bot_message, bot_name)
+        except Exception as exc:
+            logger.error("Could not ask the bots: {}".format(exc))
+            answer = self.main_bot_fallback(bot_name)
 
         logger.warning(answer)
+        logger.info("HTTP pool stats: {}".format(get_stats()))
+        logger.info("Answer cache stats: {}".format(self.cache.get_stats()))
+
+        # pika channels are not thread safe, the reply is sent by the
+        # connection thread.
+        self.connection.add_callback_threadsafe(
+            functools.partial(self.reply, ch, delivery_tag, props, answer)
+        )
 
+    def reply(self, ch, delivery_tag, props, answer):
         ch.basic_publish(
             exchange="",
             routing_key=props.reply_to,
@@ -182,7 +370,7 @@ class RPCServer:
                 correlation_id=props.correlation_id),
             body=json.dumps(answer),
         )
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        ch.basic_ack(delivery_tag=delivery_tag)
 
     def get_policy_info(self, iterator):
         event = next(iterator)
@@ -200,7 +388,11 @@ class RPCServer:
         return best_answer
 
     def start_server(self):
-        self.channel.basic_qos(prefetch_count=1)
+        if self.cache.max_size > 0:
+            threading.Thread(
+                target=self.watch_bots_versions, daemon=True).start()
+
+        self.channel.basic_qos(prefetch_count=self.prefetch)
         self.channel.basic_consume(
             queue="rpc_queue", on_message_callback=self.on_request
         )
@@ -221,6 +413,20 @@ def connect_rabbit():
     return None
 
 
-if __name__ == "__main__":
+def run_worker():
     rpc_server = connect_rabbit()
     rpc_server.start_server()
+
+
+if __name__ == "__main__":
+    if WORKERS > 1:
+        # Each process has its own broker connection and bots sessions
+        workers = [
+            multiprocessing.Process(target=run_worker) for _ in range(WORKERS)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        run_worker()
@@ -0,0 +1,35 @@
+import os
+import threading
+
+
+class SenderPool:
+    """Sender ids the union talks to the bots with. An id is used by a
+    single question at a time and handed out again once its conversation
+    was reset, so the bots only keep as many conversations as the union
+    asks at the same time."""
+
+    def __init__(self, prefix=None):
+        if prefix is None:
+            # Server processes share the bots, their ids must not collide
+            prefix = "union-{}".format(os.getpid())
+
+        self.prefix = prefix
+        self.size = 0
+        self.free = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+
+            self.size += 1
+            return "{}-{}".format(self.prefix, self.size)
+
+    def release(self, sender_id):
+        """Returns an id whose conversation is empty again. Ids that could
+        not be reset, or whose question was interrupted, are not released,
+        a new one takes their place."""
+
+        with self.lock:
+            self.free.append(sender_id)